@@ -57,6 +57,45 @@ SPH_GROUPBY_MONTH		= 2
 SPH_GROUPBY_YEAR		= 3
 SPH_GROUPBY_ATTR		= 4
 
+class MatchDecoder:
+	"""
+	decodes the matches of a result set with a given schema; every attribute is a 32-bit
+	integer here, so a whole match (id, weight and attributes) is compiled into a single Struct
+	and turned into a match by a function built for the schema
+	"""
+	def __init__ (self, attrs):
+		self.row = Struct('>2L' + 'L'*len(attrs))
+		attrs = ','.join([ '%r:v[%d]' % (attr[0], i+2) for i, attr in enumerate(attrs) ])
+		self.build = eval('lambda v: { "id":v[0], "weight":v[1], "attrs":{%s} }' % attrs)
+
+
+	def Decode (self, response, p, count):
+		"""
+		decode 'count' matches starting at offset 'p', returning (matches, new offset)
+		"""
+		matches = []
+		unpack, size, build = self.row.unpack_from, self.row.size, self.build
+		append = matches.append
+		for i in xrange(count):
+			append(build(unpack(response, p)))
+			p += size
+		return matches, p
+
+
+_decoders = {}
+
+def GetMatchDecoder (attrs):
+	"""
+	return a (cached) MatchDecoder for the given result schema
+	"""
+	key = tuple([ attr[0] for attr in attrs ])
+	decoder = _decoders.get(key)
+	if decoder is None:
+		if len(_decoders)>=256:
+			_decoders.clear()
+		decoder = _decoders[key] = MatchDecoder(attrs)
+	return decoder
+
 class SphinxClient:
 	_host		= 'localhost'			# searchd host (default is "localhost")
 	_port		= 3312					# searchd port (default is 3312)
@@ -122,7 +161,13 @@ class SphinxClient:
 			self._error = 'connection to %s:%s failed (%s)' % ( self._host, self._port, msg )
 			return 0
 
-		v = unpack('>L', sock.recv(4))
+		v = self._Recv(sock, 4)
+		if len(v)!=4:
+			sock.close()
+			self._error = 'connection to %s:%s failed (no protocol version received)' % ( self._host, self._port )
+			return 0
+
+		v = unpack('>L', v)[0]
 		if v<1:
 			sock.close()
 			self._error = 'expected searchd protocol version, got %s' % v
@@ -133,26 +178,39 @@ class SphinxClient:
 		return sock
 
 
-	def _GetResponse (self, sock, client_ver):
+	def _Recv (self, sock, size):
 		"""
-		get and check response packet from searchd server
+		read up to 'size' bytes into a single preallocated buffer, returning a memoryview
+		over the bytes read (shorter than 'size' only if the connection was closed)
 		"""
-		(status, ver, length) = unpack('>2HL', sock.recv(8))
-		response = ''
-		left = length
-		while left>0:
-			chunk = sock.recv(left)
-			if chunk:
-				response += chunk
-				left -= len(chunk)
-			else:
+		view = memoryview(bytearray(size))
+		read = 0
+		while read<size:
+			chunk = sock.recv_into(view[read:], size-read)
+			if not chunk:
 				break
+			read += chunk
+		return view[:read]
+
+
+	def _GetResponse (self, sock, client_ver):
+		"""
+		get and check response packet from searchd server, returning a memoryview over its body
+		"""
+		header = self._Recv(sock, 8)
+		if len(header)!=8:
+			sock.close()
+			self._error = 'failed to read searchd response header (read=%d)' % len(header)
+			return None
+
+		(status, ver, length) = unpack('>2HL', header)
+		response = self._Recv(sock, length)
 
 		sock.close()
 
 		# check response
 		read = len(response)
-		if not response or read!=length:
+		if not read or read!=length:
 			if length:
 				self._error = 'failed to read searchd response (status=%s, ver=%s, len=%s, read=%s)' \
 					% (status, ver, length, read)
@@ -162,16 +220,16 @@ class SphinxClient:
 
 		# check status
 		if status==SEARCHD_WARNING:
-			wend = 4 + unpack ( '>L', response[0:4] )[0]
-			self._warning = response[4:wend]
+			wend = 4 + unpack_from ( '>L', response, 0 )[0]
+			self._warning = response[4:wend].tobytes()
 			return response[wend:]
 
 		if status==SEARCHD_ERROR:
-			self._error = 'searchd error: '+response[4:]
+			self._error = 'searchd error: '+response[4:].tobytes()
 			return None
 
 		if status==SEARCHD_RETRY:
-			self._error = 'temporary searchd error: '+response[4:]
+			self._error = 'temporary searchd error: '+response[4:].tobytes()
 			return None
 
 		if status!=SEARCHD_OK:
@@ -398,51 +456,44 @@ class SphinxClient:
 		fields = []
 		attrs = []
 
-		nfields = unpack('>L', response[p:p+4])[0]
+		nfields = unpack_from('>L', response, p)[0]
 		p += 4
 		while nfields>0 and p<max_:
 			nfields -= 1
-			length = unpack('>L', response[p:p+4])[0]
+			length = unpack_from('>L', response, p)[0]
 			p += 4
-			fields.append(response[p:p+length])
+			fields.append(response[p:p+length].tobytes())
 			p += length
 
 		result['fields'] = fields
 
-		nattrs = unpack('>L', response[p:p+4])[0]
+		nattrs = unpack_from('>L', response, p)[0]
 		p += 4
 		while nattrs>0 and p<max_:
 			nattrs -= 1
-			length = unpack('>L', response[p:p+4])[0]
+			length = unpack_from('>L', response, p)[0]
 			p += 4
-			attr = response[p:p+length]
+			attr = response[p:p+length].tobytes()
 			p += length
-			type_ = unpack('>L', response[p:p+4])[0]
+			type_ = unpack_from('>L', response, p)[0]
 			p += 4
 			attrs.append([attr,type_])
 
 		result['attrs'] = attrs
 
 		# read match count
-		count = unpack('>L', response[p:p+4])[0]
+		count = unpack_from('>L', response, p)[0]
 		p += 4
 
 		# read matches
-		result['matches'] = []
-		while count>0 and p<max_:
-			count -= 1
-			doc, weight = unpack('>2L', response[p:p+8])
-			p += 8
-
-			match = { 'id':doc, 'weight':weight, 'attrs':{} }
-			for i in range(len(attrs)):
-				match['attrs'][attrs[i][0]] = unpack('>L', response[p:p+4])[0]
-				p += 4
-
-			result['matches'].append ( match )
+		try:
+			result['matches'], p = GetMatchDecoder(attrs).Decode(response, p, count)
+		except error:
+			self._error = 'incomplete reply'
+			return {}
 
 		result['total'], result['total_found'], result['time'], words = \
-			unpack('>4L', response[p:p+16])
+			unpack_from('>4L', response, p)
 
 		result['time'] = '%.3f' % (result['time']/1000.0)
 		p += 16
@@ -450,11 +501,11 @@ class SphinxClient:
 		result['words'] = []
 		while words>0:
 			words -= 1
-			length = unpack('>L', response[p:p+4])[0]
+			length = unpack_from('>L', response, p)[0]
 			p += 4
-			word = response[p:p+length]
+			word = response[p:p+length].tobytes()
 			p += length
-			docs, hits = unpack('>2L', response[p:p+8])
+			docs, hits = unpack_from('>2L', response, p)
 			p += 8
 
 			result['words'].append({'word':word, 'docs':docs, 'hits':hits})
@@ -560,14 +611,14 @@ class SphinxClient:
 		rlen = len(response)
 
 		for i in range(len(docs)):
-			length = unpack('>L', response[pos:pos+4])[0]
+			length = unpack_from('>L', response, pos)[0]
 			pos += 4
 
 			if pos+length > rlen:
 				self._error = 'incomplete reply'
 				return []
 
-			res.append(response[pos:pos+length])
+			res.append(response[pos:pos+length].tobytes())
 			pos += length
 
 		return res
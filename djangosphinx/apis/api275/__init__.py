@@ -82,6 +82,98 @@ SPH_GROUPBY_YEAR		= 3
 SPH_GROUPBY_ATTR		= 4
 
 
+# struct formats of the fixed-width attribute types (anything else is sent as a 32-bit integer)
+SPH_ATTR_FORMATS = {
+	SPH_ATTR_FLOAT:		'f',
+}
+
+SPH_ATTR_MVA = SPH_ATTR_MULTI | SPH_ATTR_INTEGER
+
+
+class MatchDecoder:
+	"""
+	Decodes the matches of a result set with a given schema.
+
+	Each run of fixed-width attributes (together with the document id and weight) is compiled into
+	a single Struct, so a match without MVA attributes is decoded with a single unpack_from() call.
+	"""
+	def __init__ (self, id64, attrs):
+		self.names = []
+		self.segments = []
+		# a 64-bit id is sent as two 32-bit halves, high one first, which is just a big-endian Q
+		fmt = [ id64 and 'QL' or '2L' ]
+		names = []
+		for name, type_ in attrs:
+			if type_ == SPH_ATTR_MVA:
+				self._AddSegment(fmt, names)
+				self.segments.append((None, name))
+				fmt, names = [], []
+			else:
+				fmt.append(SPH_ATTR_FORMATS.get(type_, 'L'))
+				names.append(name)
+			self.names.append(name)
+		self._AddSegment(fmt, names)
+
+		# without MVA attributes a whole match is one fixed-width row, which is turned into
+		# a match by a function built for this schema (a dict literal beats dict(zip()) by far)
+		self.row = None
+		if len(self.segments)==1:
+			self.row = self.segments[0][0]
+			attrs = ','.join([ '%r:v[%d]' % (name, i+2) for i, name in enumerate(self.names) ])
+			self.build = eval('lambda v: { "id":v[0], "weight":v[1], "attrs":{%s} }' % attrs)
+
+
+	def _AddSegment (self, fmt, names):
+		if fmt:
+			self.segments.append((Struct('>' + ''.join(fmt)), names))
+
+
+	def Decode (self, response, p, count):
+		"""
+		Decodes 'count' matches starting at offset 'p'. Returns (matches, new offset).
+		"""
+		matches = []
+		if self.row:
+			unpack, size, build = self.row.unpack_from, self.row.size, self.build
+			append = matches.append
+			for i in xrange(count):
+				append(build(unpack(response, p)))
+				p += size
+			return matches, p
+
+		for i in xrange(count):
+			match = None
+			for row, names in self.segments:
+				if row is None:
+					nvals = unpack_from('>L', response, p)[0]
+					match['attrs'][names] = list(unpack_from('>%dL' % nvals, response, p+4))
+					p += 4 + 4*nvals
+					continue
+				values = row.unpack_from(response, p)
+				p += row.size
+				if match is None:
+					match = { 'id':values[0], 'weight':values[1], 'attrs':dict(zip(names, values[2:])) }
+				else:
+					match['attrs'].update(zip(names, values))
+			matches.append(match)
+		return matches, p
+
+
+_decoders = {}
+
+def GetMatchDecoder (id64, attrs):
+	"""
+	Returns a (cached) MatchDecoder for the given result schema.
+	"""
+	key = (id64, tuple([ tuple(attr) for attr in attrs ]))
+	decoder = _decoders.get(key)
+	if decoder is None:
+		if len(_decoders)>=256:
+			_decoders.clear()
+		decoder = _decoders[key] = MatchDecoder(id64, attrs)
+	return decoder
+
+
 class SphinxClient:
 	def __init__ (self):
 		"""
@@ -154,7 +246,13 @@ class SphinxClient:
 			self._error = 'connection to %s:%s failed (%s)' % ( self._host, self._port, msg )
 			return 0
 
-		v = unpack('>L', sock.recv(4))
+		v = self._Recv(sock, 4)
+		if len(v)!=4:
+			sock.close()
+			self._error = 'connection to %s:%s failed (no protocol version received)' % ( self._host, self._port )
+			return 0
+
+		v = unpack('>L', v)[0]
 		if v<1:
 			sock.close()
 			self._error = 'expected searchd protocol version, got %s' % v
@@ -165,26 +263,40 @@ class SphinxClient:
 		return sock
 
 
+	def _Recv (self, sock, size):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Reads up to 'size' bytes into a single preallocated buffer.
+		Returns a memoryview over the bytes read; it is shorter than 'size' only if the connection was closed.
+		"""
+		view = memoryview(bytearray(size))
+		read = 0
+		while read<size:
+			chunk = sock.recv_into(view[read:], size-read)
+			if not chunk:
+				break
+			read += chunk
+		return view[:read]
+
+
 	def _GetResponse (self, sock, client_ver):
 		"""
 		INTERNAL METHOD, DO NOT CALL. Gets and checks response packet from searchd server.
+		Returns a memoryview over the response body.
 		"""
-		(status, ver, length) = unpack('>2HL', sock.recv(8))
-		response = ''
-		left = length
-		while left>0:
-			chunk = sock.recv(left)
-			if chunk:
-				response += chunk
-				left -= len(chunk)
-			else:
-				break
+		header = self._Recv(sock, 8)
+		if len(header)!=8:
+			sock.close()
+			self._error = 'failed to read searchd response header (read=%d)' % len(header)
+			return None
+
+		(status, ver, length) = unpack('>2HL', header)
+		response = self._Recv(sock, length)
 
 		sock.close()
 
 		# check response
 		read = len(response)
-		if not response or read!=length:
+		if not read or read!=length:
 			if length:
 				self._error = 'failed to read searchd response (status=%s, ver=%s, len=%s, read=%s)' \
 					% (status, ver, length, read)
@@ -194,16 +306,16 @@ class SphinxClient:
 
 		# check status
 		if status==SEARCHD_WARNING:
-			wend = 4 + unpack ( '>L', response[0:4] )[0]
-			self._warning = response[4:wend]
+			wend = 4 + unpack_from ( '>L', response, 0 )[0]
+			self._warning = response[4:wend].tobytes()
 			return response[wend:]
 
 		if status==SEARCHD_ERROR:
-			self._error = 'searchd error: '+response[4:]
+			self._error = 'searchd error: '+response[4:].tobytes()
 			return None
 
 		if status==SEARCHD_RETRY:
-			self._error = 'temporary searchd error: '+response[4:]
+			self._error = 'temporary searchd error: '+response[4:].tobytes()
 			return None
 
 		if status!=SEARCHD_OK:
@@ -537,13 +649,13 @@ class SphinxClient:
 			result = {}
 			result['error'] = ''
 			result['warning'] = ''
-			status = unpack('>L', response[p:p+4])[0]
+			status = unpack_from('>L', response, p)[0]
 			p += 4
 			result['status'] = status
 			if status != SEARCHD_OK:
-				length = unpack('>L', response[p:p+4])[0]
+				length = unpack_from('>L', response, p)[0]
 				p += 4
-				message = response[p:p+length]
+				message = response[p:p+length].tobytes()
 				p += length
 
 				if status == SEARCHD_WARNING:
@@ -556,68 +668,45 @@ class SphinxClient:
 			fields = []
 			attrs = []
 
-			nfields = unpack('>L', response[p:p+4])[0]
+			nfields = unpack_from('>L', response, p)[0]
 			p += 4
 			while nfields>0 and p<max_:
 				nfields -= 1
-				length = unpack('>L', response[p:p+4])[0]
+				length = unpack_from('>L', response, p)[0]
 				p += 4
-				fields.append(response[p:p+length])
+				fields.append(response[p:p+length].tobytes())
 				p += length
 
 			result['fields'] = fields
 
-			nattrs = unpack('>L', response[p:p+4])[0]
+			nattrs = unpack_from('>L', response, p)[0]
 			p += 4
 			while nattrs>0 and p<max_:
 				nattrs -= 1
-				length = unpack('>L', response[p:p+4])[0]
+				length = unpack_from('>L', response, p)[0]
 				p += 4
-				attr = response[p:p+length]
+				attr = response[p:p+length].tobytes()
 				p += length
-				type_ = unpack('>L', response[p:p+4])[0]
+				type_ = unpack_from('>L', response, p)[0]
 				p += 4
 				attrs.append([attr,type_])
 
 			result['attrs'] = attrs
 
 			# read match count
-			count = unpack('>L', response[p:p+4])[0]
+			count = unpack_from('>L', response, p)[0]
 			p += 4
-			id64 = unpack('>L', response[p:p+4])[0]
+			id64 = unpack_from('>L', response, p)[0]
 			p += 4
 		
 			# read matches
-			result['matches'] = []
-			while count>0 and p<max_:
-				count -= 1
-				if id64:
-					dochi, doc, weight = unpack('>3L', response[p:p+12])
-					doc += (dochi<<32)
-					p += 12
-				else:
-					doc, weight = unpack('>2L', response[p:p+8])
-					p += 8
-
-				match = { 'id':doc, 'weight':weight, 'attrs':{} }
-				for i in range(len(attrs)):
-					if attrs[i][1] == SPH_ATTR_FLOAT:
-						match['attrs'][attrs[i][0]] = unpack('>f', response[p:p+4])[0]
-					elif attrs[i][1] == (SPH_ATTR_MULTI | SPH_ATTR_INTEGER):
-						match['attrs'][attrs[i][0]] = []
-						nvals = unpack('>L', response[p:p+4])[0]
-						p += 4
-						for n in range(0,nvals,1):
-							match['attrs'][attrs[i][0]].append(unpack('>L', response[p:p+4])[0])
-							p += 4
-						p -= 4
-					else:
-						match['attrs'][attrs[i][0]] = unpack('>L', response[p:p+4])[0]
-					p += 4
-
-				result['matches'].append ( match )
-
-			result['total'], result['total_found'], result['time'], words = unpack('>4L', response[p:p+16])
+			try:
+				result['matches'], p = GetMatchDecoder(id64, attrs).Decode(response, p, count)
+			except error:
+				self._error = 'incomplete reply'
+				return None
+
+			result['total'], result['total_found'], result['time'], words = unpack_from('>4L', response, p)
 
 			result['time'] = '%.3f' % (result['time']/1000.0)
 			p += 16
@@ -625,11 +714,11 @@ class SphinxClient:
 			result['words'] = []
 			while words>0:
 				words -= 1
-				length = unpack('>L', response[p:p+4])[0]
+				length = unpack_from('>L', response, p)[0]
 				p += 4
-				word = response[p:p+length]
+				word = response[p:p+length].tobytes()
 				p += length
-				docs, hits = unpack('>2L', response[p:p+8])
+				docs, hits = unpack_from('>2L', response, p)
 				p += 8
 
 				result['words'].append({'word':word, 'docs':docs, 'hits':hits})
@@ -722,14 +811,14 @@ class SphinxClient:
 		rlen = len(response)
 
 		for i in range(len(docs)):
-			length = unpack('>L', response[pos:pos+4])[0]
+			length = unpack_from('>L', response, pos)[0]
 			pos += 4
 
 			if pos+length > rlen:
 				self._error = 'incomplete reply'
 				return []
 
-			res.append(response[pos:pos+length])
+			res.append(response[pos:pos+length].tobytes())
 			pos += length
 
 		return res
@@ -786,7 +875,7 @@ class SphinxClient:
 			return -1
 
 		# parse response
-		updated = unpack ( '>L', response[0:4] )[0]
+		updated = unpack_from ( '>L', response, 0 )[0]
 		return updated
 
 
@@ -821,26 +910,26 @@ class SphinxClient:
 		# parse response
 		res = []
 
-		nwords = unpack ( '>L', response[0:4] )[0]
+		nwords = unpack_from ( '>L', response, 0 )[0]
 		p = 4
 		max_ = len(response)
 
 		while nwords>0 and p<max_:
 			nwords -= 1
 
-			length = unpack ( '>L', response[p:p+4] )[0]
+			length = unpack_from ( '>L', response, p )[0]
 			p += 4
-			tokenized = response[p:p+length]
+			tokenized = response[p:p+length].tobytes()
 			p += length
 
-			length = unpack ( '>L', response[p:p+4] )[0]
+			length = unpack_from ( '>L', response, p )[0]
 			p += 4
-			normalized = response[p:p+length]
+			normalized = response[p:p+length].tobytes()
 			p += length
 
 			entry = { 'tokenized':tokenized, 'normalized':normalized }
 			if hits:
-				entry['docs'], entry['hits'] = unpack ( '>2L', response[p:p+8] )
+				entry['docs'], entry['hits'] = unpack_from ( '>2L', response, p )
 				p += 8
 
 			res.append ( entry )
@@ -16,9 +16,16 @@
 import sys
 import select
 import socket
+import time
 import re
+from array import array
 from struct import *
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 
 # known searchd commands
 SEARCHD_COMMAND_SEARCH	= 0
@@ -95,6 +102,168 @@ SPH_GROUPBY_ATTR		= 4
 SPH_GROUPBY_ATTRPAIR	= 5
 
 
+# struct formats of the fixed-width attribute types (anything else is sent as a 32-bit integer)
+SPH_ATTR_FORMATS = {
+	SPH_ATTR_FLOAT:		'f',
+	SPH_ATTR_BIGINT:	'q',
+}
+
+SPH_ATTR_MVA = SPH_ATTR_MULTI | SPH_ATTR_INTEGER
+
+
+def _ArrayTypecode (fmt):
+	# array typecodes differ in size between platforms (and Python 2 has no 'q'/'Q'),
+	# so pick the smallest one wide enough, and fall back to doubles for 64-bit values
+	if fmt=='f':
+		return 'f'
+	size = calcsize('>'+fmt)
+	for code in (fmt.isupper() and 'ILQ' or 'ilq'):
+		try:
+			if array(code).itemsize>=size:
+				return code
+		except ValueError:
+			pass
+	return 'd'
+
+SPH_ARRAY_TYPECODES = dict([ (fmt, _ArrayTypecode(fmt)) for fmt in ('f', 'L', 'q', 'Q') ])
+
+
+def MakeColumn (fmt, values):
+	"""
+	Builds a column of decoded values of struct format 'fmt': a NumPy array if NumPy
+	is installed, an array.array otherwise.
+	"""
+	column = array(SPH_ARRAY_TYPECODES[fmt], values)
+	if numpy is not None:
+		column = numpy.frombuffer(column, dtype=column.typecode)
+	return column
+
+
+class MatchDecoder:
+	"""
+	Decodes the matches of a result set with a given schema.
+
+	Each run of fixed-width attributes (together with the document id and weight) is compiled into
+	a single Struct, so a match without MVA attributes is decoded with a single unpack_from() call.
+	"""
+	def __init__ (self, id64, attrs):
+		self.names = []
+		self.columns = [ ('@id', id64 and 'Q' or 'L'), ('@weight', 'L') ]
+		self.segments = []
+		fmt = [ id64 and 'QL' or '2L' ]
+		names = [ '@id', '@weight' ]
+		for name, type_ in attrs:
+			if type_ == SPH_ATTR_MVA:
+				self._AddSegment(fmt, names)
+				self.segments.append((None, name))
+				fmt, names = [], []
+			else:
+				fmt.append(SPH_ATTR_FORMATS.get(type_, 'L'))
+				names.append(name)
+				self.columns.append((name, fmt[-1]))
+			self.names.append(name)
+		self._AddSegment(fmt, names)
+
+		# without MVA attributes a whole match is one fixed-width row, which is turned into
+		# a match by a function built for this schema (a dict literal beats dict(zip()) by far)
+		self.row = None
+		if len(self.segments)==1:
+			self.row = self.segments[0][0]
+			attrs = ','.join([ '%r:v[%d]' % (name, i+2) for i, name in enumerate(self.names) ])
+			self.build = eval('lambda v: { "id":v[0], "weight":v[1], "attrs":{%s} }' % attrs)
+
+
+	def _AddSegment (self, fmt, names):
+		if fmt:
+			self.segments.append((Struct('>' + ''.join(fmt)), names))
+
+
+	def Decode (self, response, p, count):
+		"""
+		Decodes 'count' matches starting at offset 'p'. Returns (matches, new offset).
+		"""
+		matches = []
+		if self.row:
+			unpack, size, build = self.row.unpack_from, self.row.size, self.build
+			append = matches.append
+			for i in xrange(count):
+				append(build(unpack(response, p)))
+				p += size
+			return matches, p
+
+		for i in xrange(count):
+			match = None
+			for row, names in self.segments:
+				if row is None:
+					nvals = unpack_from('>L', response, p)[0]
+					match['attrs'][names] = list(unpack_from('>%dL' % nvals, response, p+4))
+					p += 4 + 4*nvals
+					continue
+				values = row.unpack_from(response, p)
+				p += row.size
+				if match is None:
+					match = { 'id':values[0], 'weight':values[1], 'attrs':dict(zip(names[2:], values[2:])) }
+				else:
+					match['attrs'].update(zip(names, values))
+			matches.append(match)
+		return matches, p
+
+
+	def DecodeColumns (self, response, p, count):
+		"""
+		Decodes 'count' matches starting at offset 'p' into one array per attribute (plus '@id'
+		and '@weight'). MVA attributes are returned as an (offsets, values) pair of arrays, where
+		the values of match i are values[offsets[i]:offsets[i+1]]. Returns (columns, new offset).
+		"""
+		if self.row:
+			# all rows are fixed-width, so the whole page is a single unpack
+			width = len(self.columns)
+			flat = Struct('>' + self.row.format[1:]*count).unpack_from(response, p)
+			p += self.row.size*count
+			columns = {}
+			for i, (name, fmt) in enumerate(self.columns):
+				columns[name] = flat[i::width]
+		else:
+			columns = dict([ (name, []) for name, fmt in self.columns ])
+			mvas = {}
+			for row, names in self.segments:
+				if row is None:
+					mvas[names] = ([0], [])
+			for i in xrange(count):
+				for row, names in self.segments:
+					if row is None:
+						offsets, values = mvas[names]
+						nvals = unpack_from('>L', response, p)[0]
+						values.extend(unpack_from('>%dL' % nvals, response, p+4))
+						offsets.append(len(values))
+						p += 4 + 4*nvals
+						continue
+					for name, value in zip(names, row.unpack_from(response, p)):
+						columns[name].append(value)
+					p += row.size
+			for name, (offsets, values) in mvas.iteritems():
+				columns[name] = (MakeColumn('L', offsets), MakeColumn('L', values))
+
+		for name, fmt in self.columns:
+			columns[name] = MakeColumn(fmt, columns[name])
+		return columns, p
+
+
+_decoders = {}
+
+def GetMatchDecoder (id64, attrs):
+	"""
+	Returns a (cached) MatchDecoder for the given result schema.
+	"""
+	key = (id64, tuple([ tuple(attr) for attr in attrs ]))
+	decoder = _decoders.get(key)
+	if decoder is None:
+		if len(_decoders)>=256:
+			_decoders.clear()
+		decoder = _decoders[key] = MatchDecoder(id64, attrs)
+	return decoder
+
+
 class SphinxClient:
 	def __init__ (self):
 		"""
@@ -132,6 +301,9 @@ class SphinxClient:
 		self._error			= ''							# last error message
 		self._warning		= ''							# last warning message
 		self._reqs			= []							# requests array for multi-query
+		self._columnar		= False							# return matches as columns rather than dicts
+		self._timeout		= 0								# overall request timeout, seconds (default is 0, do not limit)
+		self._deadline		= None							# when the current request times out
 
 	def __del__ (self):
 		if self._socket:
@@ -195,45 +367,138 @@ class SphinxClient:
 				addr = ( self._host, self._port )
 				desc = '%s;%s' % addr
 			sock = socket.socket ( af, socket.SOCK_STREAM )
+			self._ApplyDeadline ( sock )
 			sock.connect ( addr )
+		except socket.timeout:
+			return self._TimedOut(sock)
 		except socket.error, msg:
 			if sock:
 				sock.close()
 			self._error = 'connection to %s failed (%s)' % ( desc, msg )
 			return
 
-		v = unpack('>L', sock.recv(4))
+		try:
+			v = self._Recv(sock, 4)
+		except socket.timeout:
+			return self._TimedOut(sock)
+		if len(v)!=4:
+			sock.close()
+			self._error = 'connection to %s failed (no protocol version received)' % desc
+			return
+
+		v = unpack('>L', v)[0]
 		if v<1:
 			sock.close()
 			self._error = 'expected searchd protocol version, got %s' % v
 			return
 
 		# all ok, send my version
-		sock.send(pack('>L', 1))
+		if not self._Send(sock, pack('>L', 1)):
+			return
 		return sock
 
 
+	def _StartTimer (self):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Starts the clock on the timeout of a new request.
+		"""
+		if self._timeout:
+			self._deadline = time.time() + self._timeout
+		else:
+			self._deadline = None
+
+
+	def _ApplyDeadline (self, sock):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Limits the next operation on 'sock' to the time left for the current request.
+		Raises socket.timeout if there is none left.
+		"""
+		if self._deadline is None:
+			sock.settimeout(None)
+			return
+		left = self._deadline - time.time()
+		if left<=0:
+			raise socket.timeout('timed out')
+		sock.settimeout(left)
+
+
+	def _TimedOut (self, sock):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Gives up on a request which ran out of time.
+		"""
+		# anything searchd still sends would be taken for the answer to our next request
+		sock.close()
+		if sock is self._socket:
+			self._socket = None
+		self._error = 'searchd request timed out after %d ms' % (self._timeout*1000)
+		return None
+
+
+	def _Send (self, sock, data):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Sends 'data' to searchd. Returns False if the request timed out.
+		"""
+		try:
+			self._ApplyDeadline(sock)
+			sock.sendall(data)
+		except socket.timeout:
+			self._TimedOut(sock)
+			return False
+		return True
+
+
+	def _Recv (self, sock, size):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Reads up to 'size' bytes into a single preallocated buffer.
+		Returns a memoryview over the bytes read; it is shorter than 'size' only if the connection was closed.
+		Raises socket.timeout if the current request runs out of time.
+		"""
+		view = memoryview(bytearray(size))
+		read = 0
+		while read<size:
+			self._ApplyDeadline(sock)
+			chunk = sock.recv_into(view[read:], size-read)
+			if not chunk:
+				break
+			read += chunk
+		return view[:read]
+
+
 	def _GetResponse (self, sock, client_ver):
 		"""
 		INTERNAL METHOD, DO NOT CALL. Gets and checks response packet from searchd server.
+		Returns a memoryview over the response body.
 		"""
-		(status, ver, length) = unpack('>2HL', sock.recv(8))
-		response = ''
-		left = length
-		while left>0:
-			chunk = sock.recv(left)
-			if chunk:
-				response += chunk
-				left -= len(chunk)
-			else:
-				break
+		try:
+			header = self._Recv(sock, 8)
+		except socket.timeout:
+			return self._TimedOut(sock)
+		if len(header)!=8:
+			if not self._socket:
+				sock.close()
+			self._error = 'failed to read searchd response header (read=%d)' % len(header)
+			return None
+
+		(status, ver, length) = unpack('>2HL', header)
+		try:
+			response = self._Recv(sock, length)
+		except socket.timeout:
+			return self._TimedOut(sock)
 
 		if not self._socket:
 			sock.close()
 
+		return self._CheckResponse(status, ver, length, response, client_ver)
+
+
+	def _CheckResponse (self, status, ver, length, response, client_ver):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Checks a response packet read from searchd server.
+		Returns the response body, or None on failure.
+		"""
 		# check response
 		read = len(response)
-		if not response or read!=length:
+		if not read or read!=length:
 			if length:
 				self._error = 'failed to read searchd response (status=%s, ver=%s, len=%s, read=%s)' \
 					% (status, ver, length, read)
@@ -243,16 +508,16 @@ class SphinxClient:
 
 		# check status
 		if status==SEARCHD_WARNING:
-			wend = 4 + unpack ( '>L', response[0:4] )[0]
-			self._warning = response[4:wend]
+			wend = 4 + unpack_from ( '>L', response, 0 )[0]
+			self._warning = response[4:wend].tobytes()
 			return response[wend:]
 
 		if status==SEARCHD_ERROR:
-			self._error = 'searchd error: '+response[4:]
+			self._error = 'searchd error: '+response[4:].tobytes()
 			return None
 
 		if status==SEARCHD_RETRY:
-			self._error = 'temporary searchd error: '+response[4:]
+			self._error = 'temporary searchd error: '+response[4:].tobytes()
 			return None
 
 		if status!=SEARCHD_OK:
@@ -290,6 +555,15 @@ class SphinxClient:
 		self._maxquerytime = maxquerytime
 
 
+	def SetTimeout (self, timeout):
+		"""
+		Set overall timeout for each request, in seconds (float). It covers connecting,
+		sending the request and reading the response together. 0 means 'do not limit'.
+		"""
+		assert(isinstance(timeout,(int,float)) and timeout>=0)
+		self._timeout = timeout
+
+
 	def SetMatchMode (self, mode):
 		"""
 		Set matching mode.
@@ -444,6 +718,13 @@ class SphinxClient:
 		self._select = select
 
 
+	def SetColumnar (self, columnar):
+		"""
+		Return matches as result['columns'], one array per attribute, instead of a list of dicts.
+		"""
+		self._columnar = bool(columnar)
+
+
 	def ResetOverrides (self):
 		self._overrides = {}
 
@@ -473,8 +754,13 @@ class SphinxClient:
 		"""
 		assert(len(self._reqs)==0)
 		self.AddQuery(query,index,comment)
-		results = self.RunQueries()
+		return self._PickQueryResult(self.RunQueries())
 
+
+	def _PickQueryResult (self, results):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Picks the result of a single query out of a RunQueries() reply.
+		"""
 		if not results or len(results)==0:
 			return None
 		self._error = results[0]['error']
@@ -595,22 +881,37 @@ class SphinxClient:
 			self._error = 'no queries defined, issue AddQuery() first'
 			return None
 
+		self._StartTimer()
 		sock = self._Connect()
 		if not sock:
 			return None
 
-		req = ''.join(self._reqs)
-		length = len(req)+4
-		req = pack('>HHLL', SEARCHD_COMMAND_SEARCH, VER_COMMAND_SEARCH, length, len(self._reqs))+req
-		sock.send(req)
+		if not self._Send(sock, self._BuildSearchRequest()):
+			return None
 
 		response = self._GetResponse(sock, VER_COMMAND_SEARCH)
 		if not response:
 			return None
 
-		nreqs = len(self._reqs)
+		results = self._ParseSearchResponse(response, len(self._reqs))
+		if results is not None:
+			self._reqs = []
+		return results
 
-		# parse response
+
+	def _BuildSearchRequest (self):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Builds the request packet for the queries added so far.
+		"""
+		req = ''.join(self._reqs)
+		length = len(req)+4
+		return pack('>HHLL', SEARCHD_COMMAND_SEARCH, VER_COMMAND_SEARCH, length, len(self._reqs))+req
+
+
+	def _ParseSearchResponse (self, response, nreqs):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Parses the reply to a search request of 'nreqs' queries.
+		"""
 		max_ = len(response)
 		p = 0
 
@@ -621,13 +922,13 @@ class SphinxClient:
 
 			result['error'] = ''
 			result['warning'] = ''
-			status = unpack('>L', response[p:p+4])[0]
+			status = unpack_from('>L', response, p)[0]
 			p += 4
 			result['status'] = status
 			if status != SEARCHD_OK:
-				length = unpack('>L', response[p:p+4])[0]
+				length = unpack_from('>L', response, p)[0]
 				p += 4
-				message = response[p:p+length]
+				message = response[p:p+length].tobytes()
 				p += length
 
 				if status == SEARCHD_WARNING:
@@ -640,70 +941,50 @@ class SphinxClient:
 			fields = []
 			attrs = []
 
-			nfields = unpack('>L', response[p:p+4])[0]
+			nfields = unpack_from('>L', response, p)[0]
 			p += 4
 			while nfields>0 and p<max_:
 				nfields -= 1
-				length = unpack('>L', response[p:p+4])[0]
+				length = unpack_from('>L', response, p)[0]
 				p += 4
-				fields.append(response[p:p+length])
+				fields.append(response[p:p+length].tobytes())
 				p += length
 
 			result['fields'] = fields
 
-			nattrs = unpack('>L', response[p:p+4])[0]
+			nattrs = unpack_from('>L', response, p)[0]
 			p += 4
 			while nattrs>0 and p<max_:
 				nattrs -= 1
-				length = unpack('>L', response[p:p+4])[0]
+				length = unpack_from('>L', response, p)[0]
 				p += 4
-				attr = response[p:p+length]
+				attr = response[p:p+length].tobytes()
 				p += length
-				type_ = unpack('>L', response[p:p+4])[0]
+				type_ = unpack_from('>L', response, p)[0]
 				p += 4
 				attrs.append([attr,type_])
 
 			result['attrs'] = attrs
 
 			# read match count
-			count = unpack('>L', response[p:p+4])[0]
+			count = unpack_from('>L', response, p)[0]
 			p += 4
-			id64 = unpack('>L', response[p:p+4])[0]
+			id64 = unpack_from('>L', response, p)[0]
 			p += 4
 		
 			# read matches
-			result['matches'] = []
-			while count>0 and p<max_:
-				count -= 1
-				if id64:
-					doc, weight = unpack('>QL', response[p:p+12])
-					p += 12
+			try:
+				decoder = GetMatchDecoder(id64, attrs)
+				if self._columnar:
+					result['matches'] = []
+					result['columns'], p = decoder.DecodeColumns(response, p, count)
 				else:
-					doc, weight = unpack('>2L', response[p:p+8])
-					p += 8
-
-				match = { 'id':doc, 'weight':weight, 'attrs':{} }
-				for i in range(len(attrs)):
-					if attrs[i][1] == SPH_ATTR_FLOAT:
-						match['attrs'][attrs[i][0]] = unpack('>f', response[p:p+4])[0]
-					elif attrs[i][1] == SPH_ATTR_BIGINT:
-						match['attrs'][attrs[i][0]] = unpack('>q', response[p:p+8])[0]
-						p += 4
-					elif attrs[i][1] == (SPH_ATTR_MULTI | SPH_ATTR_INTEGER):
-						match['attrs'][attrs[i][0]] = []
-						nvals = unpack('>L', response[p:p+4])[0]
-						p += 4
-						for n in range(0,nvals,1):
-							match['attrs'][attrs[i][0]].append(unpack('>L', response[p:p+4])[0])
-							p += 4
-						p -= 4
-					else:
-						match['attrs'][attrs[i][0]] = unpack('>L', response[p:p+4])[0]
-					p += 4
-
-				result['matches'].append ( match )
-
-			result['total'], result['total_found'], result['time'], words = unpack('>4L', response[p:p+16])
+					result['matches'], p = decoder.Decode(response, p, count)
+			except error:
+				self._error = 'incomplete reply'
+				return None
+
+			result['total'], result['total_found'], result['time'], words = unpack_from('>4L', response, p)
 
 			result['time'] = '%.3f' % (result['time']/1000.0)
 			p += 16
@@ -711,16 +992,15 @@ class SphinxClient:
 			result['words'] = []
 			while words>0:
 				words -= 1
-				length = unpack('>L', response[p:p+4])[0]
+				length = unpack_from('>L', response, p)[0]
 				p += 4
-				word = response[p:p+length]
+				word = response[p:p+length].tobytes()
 				p += length
-				docs, hits = unpack('>2L', response[p:p+8])
+				docs, hits = unpack_from('>2L', response, p)
 				p += 8
 
 				result['words'].append({'word':word, 'docs':docs, 'hits':hits})
-		
-		self._reqs = []
+
 		return results
 	
 
@@ -738,11 +1018,26 @@ class SphinxClient:
 		assert(isinstance(words, str))
 		assert(isinstance(opts, dict))
 
+		self._StartTimer()
 		sock = self._Connect()
 
 		if not sock:
 			return None
 
+		if not self._Send(sock, self._BuildExcerptsRequest(docs, index, words, opts)):
+			return []
+
+		response = self._GetResponse(sock, VER_COMMAND_EXCERPT )
+		if not response:
+			return []
+
+		return self._ParseExcerptsResponse(response, len(docs))
+
+
+	def _BuildExcerptsRequest (self, docs, index, words, opts):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Builds the request packet for BuildExcerpts().
+		"""
 		# fixup options
 		opts.setdefault('before_match', '<b>')
 		opts.setdefault('after_match', '</b>')
@@ -798,27 +1093,26 @@ class SphinxClient:
 		length = len(req)
 
 		# add header
-		req = pack('>2HL', SEARCHD_COMMAND_EXCERPT, VER_COMMAND_EXCERPT, length)+req
-		wrote = sock.send(req)
+		return pack('>2HL', SEARCHD_COMMAND_EXCERPT, VER_COMMAND_EXCERPT, length)+req
 
-		response = self._GetResponse(sock, VER_COMMAND_EXCERPT )
-		if not response:
-			return []
 
-		# parse response
+	def _ParseExcerptsResponse (self, response, ndocs):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Parses the reply to an excerpts request for 'ndocs' documents.
+		"""
 		pos = 0
 		res = []
 		rlen = len(response)
 
-		for i in range(len(docs)):
-			length = unpack('>L', response[pos:pos+4])[0]
+		for i in range(ndocs):
+			length = unpack_from('>L', response, pos)[0]
 			pos += 4
 
 			if pos+length > rlen:
 				self._error = 'incomplete reply'
 				return []
 
-			res.append(response[pos:pos+length])
+			res.append(response[pos:pos+length].tobytes())
 			pos += length
 
 		return res
@@ -847,7 +1141,28 @@ class SphinxClient:
 			for val in entry:
 				assert ( isinstance ( val, int ) )
 
-		# build request
+		# connect, send query, get response
+		self._StartTimer()
+		sock = self._Connect()
+		if not sock:
+			return None
+
+		if not self._Send ( sock, self._BuildUpdateRequest ( index, attrs, values ) ):
+			return -1
+
+		response = self._GetResponse ( sock, VER_COMMAND_UPDATE )
+		if not response:
+			return -1
+
+		# parse response
+		updated = unpack_from ( '>L', response, 0 )[0]
+		return updated
+
+
+	def _BuildUpdateRequest ( self, index, attrs, values ):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Builds the request packet for UpdateAttributes().
+		"""
 		req = [ pack('>L',len(index)), index ]
 
 		req.append ( pack('>L',len(attrs)) )
@@ -860,23 +1175,9 @@ class SphinxClient:
 			for val in entry:
 				req.append ( pack('>L',val) )
 
-		# connect, send query, get response
-		sock = self._Connect()
-		if not sock:
-			return None
-
 		req = ''.join(req)
 		length = len(req)
-		req = pack ( '>2HL', SEARCHD_COMMAND_UPDATE, VER_COMMAND_UPDATE, length ) + req
-		wrote = sock.send ( req )
-
-		response = self._GetResponse ( sock, VER_COMMAND_UPDATE )
-		if not response:
-			return -1
-
-		# parse response
-		updated = unpack ( '>L', response[0:4] )[0]
-		return updated
+		return pack ( '>2HL', SEARCHD_COMMAND_UPDATE, VER_COMMAND_UPDATE, length ) + req
 
 
 	def BuildKeywords ( self, query, index, hits ):
@@ -888,48 +1189,61 @@ class SphinxClient:
 		assert ( isinstance ( index, str ) )
 		assert ( isinstance ( hits, int ) )
 
-		# build request
-		req = [ pack ( '>L', len(query) ) + query ]
-		req.append ( pack ( '>L', len(index) ) + index )
-		req.append ( pack ( '>L', hits ) )
-
 		# connect, send query, get response
+		self._StartTimer()
 		sock = self._Connect()
 		if not sock:
 			return None
 
-		req = ''.join(req)
-		length = len(req)
-		req = pack ( '>2HL', SEARCHD_COMMAND_KEYWORDS, VER_COMMAND_KEYWORDS, length ) + req
-		wrote = sock.send ( req )
+		if not self._Send ( sock, self._BuildKeywordsRequest ( query, index, hits ) ):
+			return None
 
 		response = self._GetResponse ( sock, VER_COMMAND_KEYWORDS )
 		if not response:
 			return None
 
-		# parse response
+		return self._ParseKeywordsResponse ( response, hits )
+
+
+	def _BuildKeywordsRequest ( self, query, index, hits ):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Builds the request packet for BuildKeywords().
+		"""
+		req = [ pack ( '>L', len(query) ) + query ]
+		req.append ( pack ( '>L', len(index) ) + index )
+		req.append ( pack ( '>L', hits ) )
+
+		req = ''.join(req)
+		length = len(req)
+		return pack ( '>2HL', SEARCHD_COMMAND_KEYWORDS, VER_COMMAND_KEYWORDS, length ) + req
+
+
+	def _ParseKeywordsResponse ( self, response, hits ):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Parses the reply to a keywords request.
+		"""
 		res = []
 
-		nwords = unpack ( '>L', response[0:4] )[0]
+		nwords = unpack_from ( '>L', response, 0 )[0]
 		p = 4
 		max_ = len(response)
 
 		while nwords>0 and p<max_:
 			nwords -= 1
 
-			length = unpack ( '>L', response[p:p+4] )[0]
+			length = unpack_from ( '>L', response, p )[0]
 			p += 4
-			tokenized = response[p:p+length]
+			tokenized = response[p:p+length].tobytes()
 			p += length
 
-			length = unpack ( '>L', response[p:p+4] )[0]
+			length = unpack_from ( '>L', response, p )[0]
 			p += 4
-			normalized = response[p:p+length]
+			normalized = response[p:p+length].tobytes()
 			p += length
 
 			entry = { 'tokenized':tokenized, 'normalized':normalized }
 			if hits:
-				entry['docs'], entry['hits'] = unpack ( '>2L', response[p:p+8] )
+				entry['docs'], entry['hits'] = unpack_from ( '>2L', response, p )
 				p += 8
 
 			res.append ( entry )
@@ -947,13 +1261,15 @@ class SphinxClient:
 			self._error = 'already connected'
 			return
 		
+		self._StartTimer()
 		server = self._Connect()
 		if not server:
 			return
 
 		# command, command version = 0, body length = 4, body = 1
 		request = pack ( '>hhII', SEARCHD_COMMAND_PERSIST, 0, 4, 1 )
-		server.send ( request )
+		if not self._Send ( server, request ):
+			return
 		
 		self._socket = server
 
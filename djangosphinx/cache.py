@@ -0,0 +1,151 @@
+"""
+Caching of search results.
+
+Searches which come up again and again can be answered from Django's cache
+instead of searchd:
+<code>
+    SPHINX_RESULT_CACHE = True
+    SPHINX_RESULT_CACHE_TIMEOUT = 60
+</code>
+
+Results are cached by everything which goes into the search request: the
+query, the indexes, and every setting of the client (filters, sorting,
+grouping, limits and so on). Each index also has a generation, which is part
+of the key, so that everything cached for an index can be dropped at once
+after it has been rebuilt or rotated:
+<code>
+    from djangosphinx import cache
+
+    cache.invalidate('documents')
+</code>
+
+Results which came with a warning from searchd (such as a search cut short
+by ``SetMaxQueryTime()``) are never cached.
+
+The passages built for search results (see ``set_options(passages=True)``)
+can be cached as well:
+<code>
+    SPHINX_EXCERPT_CACHE = True
+    SPHINX_EXCERPT_CACHE_TIMEOUT = 3600
+</code>
+
+Passages are keyed by the index, the document, a hash of its fields' text,
+the query words and the excerpt options, so a changed document gets new
+passages right away.
+"""
+import re
+import time
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+__all__ = ('bump_version', 'digest', 'get', 'get_excerpt_key', 'get_excerpts', 'get_key', 'get_versions',
+           'invalidate', 'set', 'set_excerpts')
+
+SPHINX_RESULT_CACHE             = bool(getattr(settings, 'SPHINX_RESULT_CACHE', False))
+SPHINX_RESULT_CACHE_TIMEOUT     = int(getattr(settings, 'SPHINX_RESULT_CACHE_TIMEOUT', 60))
+SPHINX_EXCERPT_CACHE            = bool(getattr(settings, 'SPHINX_EXCERPT_CACHE', False))
+SPHINX_EXCERPT_CACHE_TIMEOUT    = int(getattr(settings, 'SPHINX_EXCERPT_CACHE_TIMEOUT', 3600))
+
+CACHE_PREFIX = 'djangosphinx:results'
+EXCERPT_CACHE_PREFIX = 'djangosphinx:excerpts'
+
+# The settings of a SphinxClient which make up a search. Older APIs keep their
+# defaults on the class, so these are read with getattr() rather than from the
+# instance, and settings an API doesn't have are simply None.
+QUERY_ATTRS = ('_offset', '_limit', '_mode', '_weights', '_sort', '_sortby',
+               '_min_id', '_max_id', '_filters', '_groupby', '_groupfunc',
+               '_groupsort', '_groupdistinct', '_maxmatches', '_cutoff',
+               '_anchor', '_indexweights', '_ranker', '_maxquerytime',
+               '_fieldweights', '_overrides', '_select', '_columnar')
+
+def _canonical(value):
+    # Dictionaries don't repr in the same order every time
+    if isinstance(value, dict):
+        return sorted([(k, _canonical(v)) for k, v in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+def _indexes(index):
+    return [i for i in re.split(r'[\s,;]+', index) if i]
+
+def digest(value):
+    return md5(value).hexdigest()
+
+def get_versions(keys):
+    """
+    Returns the version numbers stored under ``keys``, for keys of cached
+    entries which can all be dropped at once by moving on to a new version.
+    """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Start from the clock rather than 1, so a version which got
+            # evicted can't bring back entries cached under an older one
+            cache.add(key, int(time.time()))
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+def bump_version(key):
+    """
+    Moves the version stored under ``key`` on, see ``get_versions()``.
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        get_versions([key])
+
+def _generation_key(index):
+    return '%s:%s:generation' % (CACHE_PREFIX, index)
+
+def get_key(client, query, index):
+    """
+    Returns the cache key for the search of ``query`` on ``index`` with the
+    settings of ``client``.
+    """
+    state = [(k, _canonical(getattr(client, k, None))) for k in QUERY_ATTRS]
+    generations = get_versions([_generation_key(i) for i in _indexes(index)])
+    signature = repr((query, index, generations, state))
+    return '%s:%s' % (CACHE_PREFIX, digest(signature))
+
+def get(key):
+    return cache.get(key)
+
+def set(key, results):
+    cache.set(key, results, SPHINX_RESULT_CACHE_TIMEOUT)
+
+def invalidate(index):
+    """
+    Drops every cached result for ``index`` (a name, or several separated by
+    spaces or commas), by moving it on to a new generation.
+    """
+    for name in _indexes(index):
+        bump_version(_generation_key(name))
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def get_excerpt_key(index, instance, docs, words, opts):
+    """
+    Returns the cache key for the passages of ``instance`` on ``index``,
+    where ``docs`` is the text of its fields.
+    """
+    content = digest(''.join([md5(_encode(doc)).digest() for doc in docs]))
+    words = ' '.join(_encode(words).lower().split())
+    signature = repr((index, instance._meta.db_table, _encode(instance.pk), content, words, _canonical(opts)))
+    return '%s:%s' % (EXCERPT_CACHE_PREFIX, digest(signature))
+
+def get_excerpts(keys):
+    return cache.get_many(keys)
+
+def set_excerpts(passages):
+    cache.set_many(passages, SPHINX_EXCERPT_CACHE_TIMEOUT)
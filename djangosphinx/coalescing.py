@@ -0,0 +1,89 @@
+"""
+Coalescing of identical concurrent searches.
+
+When a search suddenly becomes popular, many threads of a process can send
+the very same request to searchd at the same moment. With coalescing turned
+on, only the first of them goes to searchd, and the others wait for its
+answer and get a copy of it:
+<code>
+    SPHINX_COALESCE = True
+</code>
+
+Requests are only considered identical when their packed queries match byte
+for byte. A thread waiting on another one's request still gives up when its
+own timeout (see ``set_options(timeout_ms=)``) runs out. Requires search API
+275 (Sphinx 0.9.8) or later.
+"""
+import copy
+import threading
+
+from django.conf import settings
+
+import djangosphinx.apis.current as sphinxapi
+from djangosphinx.connection import TIMEOUT_ERROR
+
+__all__ = ('run_queries',)
+
+SPHINX_COALESCE = bool(getattr(settings, 'SPHINX_COALESCE', False))
+
+def is_enabled():
+    return SPHINX_COALESCE and hasattr(sphinxapi.SphinxClient, 'AddQuery')
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = 'coalesced searchd request failed'
+        self.warning = ''
+        self.waiters = 0
+
+_calls = {}
+_lock = threading.Lock()
+
+def run_queries(client, run):
+    """
+    Returns ``run()``, the result of ``client.RunQueries()``, unless another
+    thread is already running the same queries. In that case it waits for
+    those results instead, and sets their error and warning on ``client``.
+    """
+    # The request alone doesn't say whether the results are decoded as columns
+    key = (''.join(client._reqs), getattr(client, '_columnar', False))
+    _lock.acquire()
+    try:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+        else:
+            call.waiters += 1
+    finally:
+        _lock.release()
+
+    if leader:
+        try:
+            call.result = run()
+            call.error, call.warning = client.GetLastError(), client.GetLastWarning()
+        finally:
+            _lock.acquire()
+            try:
+                del _calls[key]
+                waiters = call.waiters
+            finally:
+                _lock.release()
+            call.done.set()
+        # Results get written to while they are turned into model instances, so
+        # once others wait on them, each caller gets a copy and the original stays as is
+        if waiters and call.result is not None:
+            return copy.deepcopy(call.result)
+        return call.result
+
+    timeout = getattr(client, '_timeout', 0) or None
+    call.done.wait(timeout)
+    if not call.done.isSet():
+        client._error = '%s after %d ms' % (TIMEOUT_ERROR, timeout * 1000)
+        return None
+    client._error, client._warning = call.error, call.warning
+    if call.result is None:
+        return None
+    client._reqs = []
+    return copy.deepcopy(call.result)
@@ -0,0 +1,431 @@
+"""
+Connection handling for searchd.
+
+Searches can be spread over several identical searchd servers by listing
+them in ``SPHINX_SERVERS``, optionally with a weight, instead of using
+``SPHINX_SERVER`` and ``SPHINX_PORT``:
+<code>
+    SPHINX_SERVERS = (
+        ('10.0.0.1', 3312),
+        ('10.0.0.2', 3312, 2),
+        '/var/run/searchd.sock',
+    )
+</code>
+
+Each search goes to the server with the fewest requests in flight (relative
+to its weight). Servers which refuse connections or drop them are ejected,
+and probed in the background every ``SPHINX_PROBE_INTERVAL`` seconds until
+they answer again. So are servers which run out of time while connecting
+``SPHINX_EJECT_TIMEOUTS`` times in a row; a search whose connection times out
+moves on to the next server while it still has time left.
+
+By default every search opens (and closes) its own connection to searchd. If
+you are running Sphinx 0.9.9 (``SPHINX_API_VERSION = 0x116``) you can instead
+keep a pool of persistent connections around:
+<code>
+    SPHINX_POOL_SIZE = 8
+</code>
+
+Each thread is given its own persistent connection, up to ``SPHINX_POOL_SIZE``
+connections per server and process. Threads beyond that limit fall back to a
+regular connection per request. Keep in mind that each persistent connection
+holds on to one of searchd's ``max_children`` slots for as long as it stays open.
+"""
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+from django.conf import settings
+
+import djangosphinx.apis.current as sphinxapi
+
+__all__ = ('Balancer', 'ConnectionPool', 'Endpoint', 'get_balancer', 'reset_client')
+
+SPHINX_POOL_SIZE        = int(getattr(settings, 'SPHINX_POOL_SIZE', 0))
+SPHINX_PROBE_INTERVAL   = float(getattr(settings, 'SPHINX_PROBE_INTERVAL', 5))
+SPHINX_EJECT_TIMEOUTS   = int(getattr(settings, 'SPHINX_EJECT_TIMEOUTS', 3))
+
+# Attributes of a SphinxClient which describe the connection rather than the query
+CONNECTION_ATTRS = ('_host', '_port', '_path', '_socket')
+
+# Errors set by SphinxClient which mean searchd itself could not be reached,
+# as opposed to searchd refusing a query
+NETWORK_ERRORS = ('connection to', 'failed to read', 'received zero-sized', 'expected searchd protocol')
+
+# Error set by SphinxClient when a request runs out of time (see SetTimeout)
+TIMEOUT_ERROR = 'searchd request timed out'
+
+def supports_persistent_connections():
+    return hasattr(sphinxapi.SphinxClient, 'Open')
+
+def supports_timeouts():
+    return hasattr(sphinxapi.SphinxClient, 'SetTimeout')
+
+def is_network_error(error):
+    return bool(error) and error.startswith(NETWORK_ERRORS)
+
+def is_timeout_error(error):
+    return bool(error) and error.startswith(TIMEOUT_ERROR)
+
+def reset_client(client):
+    """
+    Restores all query settings of ``client`` to their defaults while keeping
+    its connection (and anything else which is not a SphinxClient default) intact.
+    """
+    defaults = sphinxapi.SphinxClient().__dict__
+    for key, value in defaults.iteritems():
+        if key not in CONNECTION_ATTRS:
+            client.__dict__[key] = value
+    return client
+
+def is_alive(sock):
+    # A healthy idle connection is writable and has nothing for us to read, a
+    # readable socket means searchd either hung up or sent something unexpected.
+    try:
+        sr, sw, _ = select.select([sock], [sock], [], 0)
+    except (select.error, ValueError):
+        return False
+    return len(sr) == 0 and len(sw) == 1
+
+class EndpointClient(sphinxapi.SphinxClient):
+    """
+    A SphinxClient bound to an Endpoint. It keeps count of the endpoint's
+    requests in flight, and reports connection failures to it.
+    """
+    def __init__(self, endpoint):
+        sphinxapi.SphinxClient.__init__(self)
+        self._inflight = False
+        self._bind(endpoint)
+
+    def _bind(self, endpoint):
+        self.endpoint = endpoint
+        self.SetServer(endpoint.host, endpoint.port)
+
+    def _end_request(self, ok):
+        if self._inflight:
+            self._inflight = False
+            self.endpoint.end(ok)
+
+    def _connect_within(self, share):
+        # Give the server only a share of the time left, so that one which
+        # hangs while connecting leaves some for the next
+        deadline = getattr(self, '_deadline', None)
+        if deadline is not None and share < 1:
+            self._deadline = time.time() + (deadline - time.time()) * share
+        try:
+            return sphinxapi.SphinxClient._Connect(self)
+        finally:
+            if deadline is not None:
+                self._deadline = deadline
+
+    def _Connect(self):
+        # A request which never got to read its response is over by now
+        self._end_request(True)
+        balancer = self.endpoint.balancer
+        attempts = len(balancer.endpoints)
+        while True:
+            attempts -= 1
+            spare = attempts and balancer.choose(exclude=self.endpoint)
+            sock = self._connect_within(spare and 0.5 or 1)
+            if sock:
+                break
+            if is_timeout_error(self._error):
+                self.endpoint.timed_out()
+            else:
+                self.endpoint.failed()
+            # Fail over to the next server still up, if any, while there is time left
+            endpoint = attempts and balancer.choose(exclude=self.endpoint)
+            deadline = getattr(self, '_deadline', None)
+            if not endpoint or (deadline is not None and deadline <= time.time()):
+                return sock
+            self._bind(endpoint)
+        self.endpoint.connected()
+        self._inflight = True
+        self.endpoint.begin()
+        return sock
+
+    def _GetResponse(self, sock, client_ver):
+        ok = False
+        try:
+            response = sphinxapi.SphinxClient._GetResponse(self, sock, client_ver)
+            ok = response is not None or not is_network_error(self._error)
+            return response
+        finally:
+            self._end_request(ok)
+
+    def _TimedOut(self, sock):
+        # Running out of time says nothing about the server's health
+        self._end_request(True)
+        return sphinxapi.SphinxClient._TimedOut(self, sock)
+
+    def RunQueries(self):
+        from djangosphinx import coalescing
+        if coalescing.is_enabled() and self._reqs:
+            return coalescing.run_queries(self, lambda: sphinxapi.SphinxClient.RunQueries(self))
+        return sphinxapi.SphinxClient.RunQueries(self)
+
+    def Open(self):
+        sphinxapi.SphinxClient.Open(self)
+        self._end_request(bool(self._socket))
+
+class _PooledClient(object):
+    """
+    Holds a thread's persistent client and gives its slot back to the pool once
+    the thread (and with it the thread local storage) goes away.
+    """
+    def __init__(self, pool, client):
+        self.pool = pool
+        self.client = client
+
+    def __del__(self):
+        if self.client._socket:
+            self.client.Close()
+        self.pool._release()
+
+class ConnectionPool(object):
+    """
+    A process-wide pool of persistent searchd connections, one per thread.
+    ``factory`` is called to create a new (unconnected) client.
+    """
+    def __init__(self, factory, max_size=SPHINX_POOL_SIZE):
+        self.factory = factory
+        self.max_size = max_size
+        self._size = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __len__(self):
+        return self._size
+
+    def _acquire(self):
+        self._lock.acquire()
+        try:
+            if self._size >= self.max_size:
+                return False
+            self._size += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _release(self):
+        self._lock.acquire()
+        try:
+            self._size -= 1
+        finally:
+            self._lock.release()
+
+    def _open(self):
+        if not self._acquire():
+            return None
+        client = self.factory()
+        client.Open()
+        if not client._socket:
+            self._release()
+            return None
+        self._local.pooled = _PooledClient(self, client)
+        return client
+
+    def get_client(self):
+        """
+        Returns this thread's persistent client, opening (or reopening) the
+        connection if needed. When the pool is exhausted, or searchd refuses the
+        connection, a regular non-persistent client is returned instead.
+        """
+        pooled = getattr(self._local, 'pooled', None)
+        if pooled is not None:
+            if pooled.client._socket and is_alive(pooled.client._socket):
+                return reset_client(pooled.client)
+            # Dropping the last reference closes the socket and frees the slot
+            self._local.pooled = pooled = None
+        client = self._open()
+        if client is None:
+            client = self.factory()
+        return client
+
+    def close(self):
+        """Closes the calling thread's persistent connection, if it has one."""
+        self._local.pooled = None
+
+class Endpoint(object):
+    """
+    A single searchd server, given by host and port or by a unix socket path.
+    """
+    def __init__(self, balancer, host, port=None, weight=1):
+        self.balancer = balancer
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.outstanding = 0
+        self.timeouts = 0
+        self.ejected = False
+        self.pool = ConnectionPool(self.new_client)
+
+    def __repr__(self):
+        if self.port is None:
+            return '<%s %s>' % (self.__class__.__name__, self.host)
+        return '<%s %s:%s>' % (self.__class__.__name__, self.host, self.port)
+
+    def new_client(self):
+        return EndpointClient(self)
+
+    def get_client(self):
+        """
+        Returns a client for this server, backed by a persistent connection
+        when pooling is enabled and supported by the search API.
+        """
+        if SPHINX_POOL_SIZE > 0 and supports_persistent_connections():
+            return self.pool.get_client()
+        return self.new_client()
+
+    def load(self):
+        return self.outstanding / float(self.weight)
+
+    def begin(self):
+        self.balancer._lock.acquire()
+        try:
+            self.outstanding += 1
+        finally:
+            self.balancer._lock.release()
+
+    def end(self, ok=True):
+        self.balancer._lock.acquire()
+        try:
+            self.outstanding -= 1
+        finally:
+            self.balancer._lock.release()
+        if not ok:
+            self.failed()
+
+    def failed(self):
+        self.balancer.eject(self)
+
+    def timed_out(self):
+        """
+        Counts a connection which ran out of time. Too many of them in a row
+        (see ``SPHINX_EJECT_TIMEOUTS``) eject the server.
+        """
+        self.balancer._lock.acquire()
+        try:
+            self.timeouts += 1
+            eject = self.timeouts >= SPHINX_EJECT_TIMEOUTS
+        finally:
+            self.balancer._lock.release()
+        if eject:
+            self.failed()
+
+    def connected(self):
+        self.timeouts = 0
+
+    def probe(self):
+        """
+        Returns True if searchd accepts a connection and sends its protocol version.
+        """
+        if self.port is None:
+            family, addr = socket.AF_UNIX, self.host
+            if addr.startswith('unix://'):
+                addr = addr[7:]
+        else:
+            family, addr = socket.AF_INET, (self.host, self.port)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.settimeout(SPHINX_PROBE_INTERVAL)
+                sock.connect(addr)
+                data = ''
+                while len(data) < 4:
+                    chunk = sock.recv(4 - len(data))
+                    if not chunk:
+                        return False
+                    data += chunk
+                return struct.unpack('>L', data)[0] >= 1
+            except socket.error:
+                return False
+        finally:
+            sock.close()
+
+class Balancer(object):
+    """
+    Spreads requests over a set of identical searchd servers, sending each
+    one to the server with the fewest requests in flight for its weight.
+    """
+    def __init__(self, servers):
+        self._lock = threading.Lock()
+        self._prober = None
+        self.endpoints = []
+        for server in servers:
+            if isinstance(server, basestring):
+                server = (server,)
+            self.endpoints.append(Endpoint(self, *server))
+
+    def choose(self, exclude=None):
+        """
+        Returns the least loaded server. With ``exclude``, returns the least
+        loaded server still up other than that one, or None if there is none.
+        """
+        endpoints = [e for e in self.endpoints if not e.ejected and e is not exclude]
+        if exclude is not None:
+            if not endpoints:
+                return None
+        elif not endpoints:
+            # Everything is down as far as we know, so try them all rather than fail outright
+            endpoints = self.endpoints
+        if len(endpoints) == 1:
+            return endpoints[0]
+        return min(endpoints, key=lambda e: (e.load(), random.random()))
+
+    def get_client(self):
+        if len(self.endpoints) > 1:
+            from djangosphinx import hedging
+            if hedging.is_enabled():
+                return hedging.HedgedClient(self)
+        return self.choose().get_client()
+
+    def eject(self, endpoint):
+        if len(self.endpoints) == 1:
+            return
+        self._lock.acquire()
+        try:
+            endpoint.ejected = True
+            if self._prober is None:
+                self._prober = threading.Thread(target=self._probe)
+                self._prober.setDaemon(True)
+                self._prober.start()
+        finally:
+            self._lock.release()
+
+    def _probe(self):
+        while True:
+            time.sleep(SPHINX_PROBE_INTERVAL)
+            for endpoint in [e for e in self.endpoints if e.ejected]:
+                if endpoint.probe():
+                    endpoint.timeouts = 0
+                    endpoint.ejected = False
+            self._lock.acquire()
+            try:
+                if not [e for e in self.endpoints if e.ejected]:
+                    self._prober = None
+                    return
+            finally:
+                self._lock.release()
+
+_balancers = {}
+_balancers_lock = threading.Lock()
+
+def get_balancer(servers):
+    """
+    Returns the process-wide Balancer for the given list of servers.
+    """
+    key = tuple([isinstance(s, basestring) and s or tuple(s) for s in servers])
+    balancer = _balancers.get(key)
+    if balancer is None:
+        _balancers_lock.acquire()
+        try:
+            balancer = _balancers.get(key)
+            if balancer is None:
+                balancer = _balancers[key] = Balancer(key)
+        finally:
+            _balancers_lock.release()
+    return balancer
@@ -0,0 +1,221 @@
+"""
+Hedged requests to searchd.
+
+With several searchd servers (see ``SPHINX_SERVERS``), a search which has not
+been answered after a while is sent to a second server as well, and whichever
+answer comes back first is used. This cuts off the slow tail of requests which
+hit a stalled searchd, at the cost of a few duplicate requests:
+<code>
+    SPHINX_HEDGE = True
+    # Hedge requests slower than 95% of recent ones
+    SPHINX_HEDGE_PERCENTILE = 95
+</code>
+
+Until enough requests have been seen to estimate the percentile, requests
+are hedged after ``SPHINX_HEDGE_DELAY`` milliseconds. The delay never drops
+below ``SPHINX_HEDGE_MIN_DELAY`` milliseconds. Use ``get_stats()`` to see how
+often requests are hedged, and how often the hedge wins.
+
+Hedged requests use the non-blocking client, and so require Sphinx 0.9.9
+(0x116). They never use persistent connections.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+import djangosphinx.apis.current as sphinxapi
+from djangosphinx import coalescing
+from djangosphinx.connection import is_network_error
+from djangosphinx.nonblocking import AsyncSphinxClient, wait
+
+__all__ = ('HedgedClient', 'get_stats', 'reset_stats')
+
+SPHINX_HEDGE            = bool(getattr(settings, 'SPHINX_HEDGE', False))
+SPHINX_HEDGE_PERCENTILE = float(getattr(settings, 'SPHINX_HEDGE_PERCENTILE', 95))
+SPHINX_HEDGE_DELAY      = float(getattr(settings, 'SPHINX_HEDGE_DELAY', 50))
+SPHINX_HEDGE_MIN_DELAY  = float(getattr(settings, 'SPHINX_HEDGE_MIN_DELAY', 5))
+
+# How many recent response times the percentile is computed from
+WINDOW_SIZE = 1000
+# Minimum number of response times needed before trusting the percentile
+MIN_SAMPLES = 100
+
+def is_enabled():
+    return SPHINX_HEDGE and hasattr(sphinxapi.SphinxClient, '_BuildSearchRequest')
+
+class LatencyTracker(object):
+    """
+    Keeps the most recent response times, and the hedging delay derived from them.
+    """
+    def __init__(self, percentile=SPHINX_HEDGE_PERCENTILE, size=WINDOW_SIZE):
+        self.percentile = percentile
+        self.size = size
+        self._samples = []
+        self._added = 0
+        self._delay = None
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        self._lock.acquire()
+        try:
+            if len(self._samples) < self.size:
+                self._samples.append(seconds)
+            else:
+                self._samples[self._added % self.size] = seconds
+            self._added += 1
+            # Sorting the window for every request would cost more than it saves
+            if self._added % 50 == 0:
+                self._delay = None
+        finally:
+            self._lock.release()
+
+    def delay(self):
+        """
+        Returns how many seconds to wait for an answer before hedging.
+        """
+        if len(self._samples) < MIN_SAMPLES:
+            return SPHINX_HEDGE_DELAY / 1000.0
+        if self._delay is None:
+            samples = sorted(self._samples)
+            index = min(len(samples) - 1, int(len(samples) * self.percentile / 100.0))
+            self._delay = max(samples[index], SPHINX_HEDGE_MIN_DELAY / 1000.0)
+        return self._delay
+
+_latency = LatencyTracker()
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+def _count(name):
+    _stats_lock.acquire()
+    try:
+        _stats[name] = _stats.get(name, 0) + 1
+    finally:
+        _stats_lock.release()
+
+def reset_stats():
+    _stats_lock.acquire()
+    try:
+        _stats.clear()
+        _stats.update(requests=0, hedged=0, hedge_wins=0, failed=0)
+    finally:
+        _stats_lock.release()
+reset_stats()
+
+def get_stats():
+    """
+    Returns the hedging counters: the number of ``requests`` made, how many
+    were ``hedged``, how many of those were answered by the hedge first
+    (``hedge_wins``), and how many ``failed`` on every server tried. ``delay``
+    is the current hedging delay, in milliseconds.
+    """
+    stats = _stats.copy()
+    stats['delay'] = _latency.delay() * 1000
+    return stats
+
+class HedgedClient(AsyncSphinxClient):
+    """
+    A SphinxClient which runs its searches and excerpt requests as hedged
+    requests over the servers of a ``djangosphinx.connection.Balancer``.
+    """
+    def __init__(self, balancer):
+        AsyncSphinxClient.__init__(self)
+        self.balancer = balancer
+        endpoint = balancer.choose()
+        self.SetServer(endpoint.host, endpoint.port)
+
+    def _Attempt(self, endpoint, command_ver, packet, parse, deadline):
+        client = AsyncSphinxClient()
+        client.SetServer(endpoint.host, endpoint.port)
+        client.SetTimeout(self._timeout)
+        # The response is decoded by the attempt's client, which has to do so
+        # the way this one would
+        client._columnar = self._columnar
+        endpoint.begin()
+        request = client._Start(command_ver, packet, lambda response: parse(client, response), deadline)
+        request.endpoint = endpoint
+        request.started = time.time()
+        return request
+
+    def _Hedge(self, command_ver, packet, parse):
+        """
+        Sends the request to a server, and to a second one if the first has
+        not answered within the hedging delay (or failed). Returns the first
+        successful result, or None if every server failed. Both attempts share
+        the client's timeout.
+        """
+        _count('requests')
+        deadline = None
+        if self._timeout:
+            deadline = time.time() + self._timeout
+        first = self.balancer.choose()
+        attempts = [self._Attempt(first, command_ver, packet, parse, deadline)]
+        hedge_at = attempts[0].started + _latency.delay()
+        winner = None
+        while True:
+            for request in attempts:
+                if request.done() and request.result() is not None:
+                    winner = request
+                    break
+            pending = [r for r in attempts if not r.done()]
+            second = None
+            if len(attempts) == 1:
+                second = self.balancer.choose(exclude=first)
+                if deadline is not None and time.time() >= deadline:
+                    second = None
+            if winner or not (pending or second):
+                break
+            if second and (not pending or time.time() >= hedge_at):
+                _count('hedged')
+                attempts.append(self._Attempt(second, command_ver, packet, parse, deadline))
+                continue
+            if second:
+                wait(*pending, **dict(first=True, timeout=max(0, hedge_at - time.time())))
+            else:
+                wait(*pending, **dict(first=True))
+
+        for request in attempts:
+            if not request.done():
+                request.cancel()
+                request.endpoint.end(True)
+            else:
+                request.endpoint.end(request.result() is not None or not is_network_error(request.client.GetLastError()))
+
+        if winner is None:
+            _count('failed')
+            self._error = attempts[-1].client.GetLastError()
+            return None
+        if winner is not attempts[0]:
+            _count('hedge_wins')
+        _latency.add(time.time() - winner.started)
+        self._error = winner.client.GetLastError()
+        self._warning = winner.client.GetLastWarning()
+        return winner.result()
+
+    def RunQueries(self):
+        if len(self._reqs)==0:
+            self._error = 'no queries defined, issue AddQuery() first'
+            return None
+        if coalescing.is_enabled():
+            return coalescing.run_queries(self, self._HedgeQueries)
+        return self._HedgeQueries()
+
+    def _HedgeQueries(self):
+        nreqs = len(self._reqs)
+        packet = self._BuildSearchRequest()
+        self._reqs = []
+        return self._Hedge(sphinxapi.VER_COMMAND_SEARCH, packet,
+                           lambda client, response: client._ParseSearchResponse(response, nreqs))
+
+    def BuildExcerpts(self, docs, index, words, opts=None):
+        if not opts:
+            opts = {}
+        if isinstance(words, unicode):
+            words = words.encode('utf-8')
+        packet = self._BuildExcerptsRequest(docs, index, words, opts)
+        result = self._Hedge(sphinxapi.VER_COMMAND_EXCERPT, packet,
+                             lambda client, response: client._ParseExcerptsResponse(response, len(docs)))
+        if result is None:
+            return []
+        return result
@@ -0,0 +1,269 @@
+"""
+Caching of the model instances loaded for search results.
+
+Search results are turned into model instances with a ``pk__in`` query per
+search. When the same documents keep coming up, those instances can be
+reused instead:
+<code>
+    # Hand out the same instance for a document within a request
+    SPHINX_IDENTITY_MAP = True
+
+    # Keep loaded instances in Django's cache
+    SPHINX_HYDRATION_CACHE = True
+    SPHINX_HYDRATION_CACHE_TIMEOUT = 300
+</code>
+
+Only the documents missing from both are loaded from the database. Cached
+instances are dropped when they are saved or deleted. Changes which bypass
+the ``post_save`` and ``post_delete`` signals (such as ``QuerySet.update()``)
+need a call to ``invalidate(Model)``, which drops every cached instance of
+the model. So do changes to models without a ``SphinxSearch`` (searched
+through a ``content_type`` attribute) made by a process which hasn't loaded
+any of them for search results itself, as saves of other models are ignored.
+
+Searches using ``select_related()``, ``extra()``, ``only()``, ``defer()`` or
+``prefetch_related()``, or models whose default manager filters its queryset,
+always load from the database.
+
+Outside of requests the identity map keeps growing until
+``clear_identity_map()`` is called.
+
+Searches over several models (through a ``content_type`` attribute) load
+each model's instances with a query of their own. These can run concurrently
+on a pool of worker threads, each with its own database connection:
+<code>
+    SPHINX_HYDRATION_THREADS = 4
+</code>
+
+Workers close their connections after ``WORKER_IDLE_TIMEOUT`` seconds without
+work, and after a database error.
+
+Leave this off when the database can't be shared between threads, such as
+SQLite's in-memory databases used by tests.
+"""
+import Queue
+import sys
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+from django.db import DatabaseError, connections
+from django.db.models.signals import post_save, post_delete
+
+from djangosphinx.cache import bump_version, digest, get_versions
+
+__all__ = ('clear_identity_map', 'get_many', 'invalidate', 'run_parallel', 'set_many')
+
+SPHINX_IDENTITY_MAP             = bool(getattr(settings, 'SPHINX_IDENTITY_MAP', False))
+SPHINX_HYDRATION_CACHE          = bool(getattr(settings, 'SPHINX_HYDRATION_CACHE', False))
+SPHINX_HYDRATION_CACHE_TIMEOUT  = int(getattr(settings, 'SPHINX_HYDRATION_CACHE_TIMEOUT', 300))
+SPHINX_HYDRATION_THREADS        = int(getattr(settings, 'SPHINX_HYDRATION_THREADS', 0))
+
+CACHE_PREFIX = 'djangosphinx:obj'
+
+# Seconds a hydration worker waits for a task before closing its database
+# connections, rather than leave them for the server to time out
+WORKER_IDLE_TIMEOUT = 30
+
+_local = threading.local()
+
+# Models without a SphinxSearch whose instances this process has loaded
+_models = set()
+
+def _identity_map():
+    try:
+        return _local.objects
+    except AttributeError:
+        _local.objects = {}
+        return _local.objects
+
+def clear_identity_map(**kwargs):
+    _local.objects = {}
+
+def is_cacheable(queryset):
+    """
+    Returns True if the instances ``queryset`` loads are plain instances of its
+    model, and it doesn't leave any of them out.
+    """
+    query = queryset.query
+    return not (query.select_related or query.extra or query.where.children or query.deferred_loading[0]
+                or getattr(queryset, '_prefetch_related_lookups', None))
+
+def _pk_key(model, instance):
+    pks = getattr(model._meta, 'pks', [model._meta.pk])
+    return tuple([getattr(instance, p.attname) for p in pks])
+
+def _model_prefix(model):
+    return '%s:%s.%s' % (CACHE_PREFIX, model._meta.app_label, model._meta.object_name.lower())
+
+def _version_key(model):
+    return '%s:version' % _model_prefix(model)
+
+def _version(model):
+    return get_versions([_version_key(model)])[0]
+
+def _cache_key(model, version, key):
+    key = u':'.join([unicode(v) for v in key]).encode('utf-8')
+    return '%s:%s:%s' % (_model_prefix(model), version, digest(key))
+
+def get_many(queryset, keys):
+    """
+    Returns the instances of ``queryset``'s model which are already known, as
+    a dictionary keyed by primary key tuple.
+    """
+    if not (SPHINX_IDENTITY_MAP or SPHINX_HYDRATION_CACHE) or not is_cacheable(queryset):
+        return {}
+    model = queryset.model
+    _models.add(model)
+    found = {}
+    if SPHINX_IDENTITY_MAP:
+        objects = _identity_map()
+        for key in keys:
+            obj = objects.get((model, key))
+            if obj is not None:
+                found[key] = obj
+    if SPHINX_HYDRATION_CACHE and len(found) < len(keys):
+        version = _version(model)
+        cache_keys = dict([(_cache_key(model, version, key), key) for key in keys if key not in found])
+        for cache_key, obj in cache.get_many(cache_keys.keys()).iteritems():
+            found[cache_keys[cache_key]] = obj
+            if SPHINX_IDENTITY_MAP:
+                _identity_map()[(model, cache_keys[cache_key])] = obj
+    return found
+
+def set_many(queryset, objects):
+    """
+    Remembers the instances loaded by ``queryset``, given as a dictionary keyed
+    by primary key tuple.
+    """
+    if not objects or not (SPHINX_IDENTITY_MAP or SPHINX_HYDRATION_CACHE) or not is_cacheable(queryset):
+        return
+    model = queryset.model
+    if SPHINX_IDENTITY_MAP:
+        identity_map = _identity_map()
+        for key, obj in objects.iteritems():
+            identity_map[(model, key)] = obj
+    if SPHINX_HYDRATION_CACHE:
+        version = _version(model)
+        values = dict([(_cache_key(model, version, key), obj) for key, obj in objects.iteritems()])
+        cache.set_many(values, SPHINX_HYDRATION_CACHE_TIMEOUT)
+
+def invalidate(model):
+    """
+    Drops every cached instance of ``model``.
+    """
+    if SPHINX_IDENTITY_MAP:
+        identity_map = _identity_map()
+        for key in [k for k in identity_map if k[0] is model]:
+            del identity_map[key]
+    if SPHINX_HYDRATION_CACHE:
+        bump_version(_version_key(model))
+
+class _Task(object):
+    def __init__(self, func):
+        self.func = func
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+        # Tasks use the identity map of the thread which started them
+        self.identity_map = _identity_map()
+
+    def run(self):
+        previous = getattr(_local, 'objects', None)
+        _local.objects = self.identity_map
+        try:
+            try:
+                self.result = self.func()
+            except:
+                self.exc_info = sys.exc_info()
+        finally:
+            _local.objects = previous
+            self.done.set()
+
+    def get(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+_tasks = Queue.Queue()
+_workers = []
+_workers_lock = threading.Lock()
+
+def _close_connections():
+    for connection in connections.all():
+        connection.close()
+
+def _work():
+    while True:
+        try:
+            task = _tasks.get(True, WORKER_IDLE_TIMEOUT)
+        except Queue.Empty:
+            _close_connections()
+            task = _tasks.get()
+        task.run()
+        if task.exc_info and issubclass(task.exc_info[0], DatabaseError):
+            # The connection may well be broken, so the next task gets a new one
+            _close_connections()
+            continue
+        # Don't leave this thread's connections idle in a transaction until the next task
+        for connection in connections.all():
+            if connection.connection is not None:
+                connection._rollback()
+
+def _start_workers():
+    if len(_workers) >= SPHINX_HYDRATION_THREADS:
+        return
+    _workers_lock.acquire()
+    try:
+        while len(_workers) < SPHINX_HYDRATION_THREADS:
+            worker = threading.Thread(target=_work)
+            worker.setDaemon(True)
+            worker.start()
+            _workers.append(worker)
+    finally:
+        _workers_lock.release()
+
+def run_parallel(funcs):
+    """
+    Calls each of ``funcs`` and returns their results in order. With
+    ``SPHINX_HYDRATION_THREADS`` set, all but the first run on the worker
+    threads while the calling thread runs the first. Exceptions are raised
+    again in the calling thread.
+    """
+    if SPHINX_HYDRATION_THREADS < 1 or len(funcs) < 2:
+        return [func() for func in funcs]
+    _start_workers()
+    tasks = [_Task(func) for func in funcs]
+    for task in tasks[1:]:
+        _tasks.put(task)
+    tasks[0].run()
+    return [task.get() for task in tasks]
+
+def _watched_model(sender):
+    # Instances loaded with only() or defer() are saved as a subclass of their model
+    if getattr(sender, '_deferred', False):
+        sender = sender._meta.proxy_for_model
+    if sender in _models or getattr(sender, '__sphinx_indexes__', None):
+        return sender
+    return None
+
+def _drop_instance(sender, instance, **kwargs):
+    # Saving any model sends these signals, so leave the cache alone for
+    # models which can't have been cached
+    sender = _watched_model(sender)
+    if sender is None:
+        return
+    key = _pk_key(sender, instance)
+    if SPHINX_IDENTITY_MAP:
+        _identity_map().pop((sender, key), None)
+    if SPHINX_HYDRATION_CACHE:
+        cache.delete(_cache_key(sender, _version(sender), key))
+
+if SPHINX_IDENTITY_MAP:
+    request_started.connect(clear_identity_map)
+    request_finished.connect(clear_identity_map)
+if SPHINX_IDENTITY_MAP or SPHINX_HYDRATION_CACHE:
+    post_save.connect(_drop_instance)
+    post_delete.connect(_drop_instance)
@@ -12,10 +12,15 @@ try:
 except ImportError:
     from django.utils import _decimal as decimal # for Python 2.3
 
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
 from django.db.models.query import QuerySet, Q
 from django.conf import settings
 
-__all__ = ('SearchError', 'ConnectionError', 'SphinxSearch', 'SphinxRelation', 'SphinxQuerySet')
+from djangosphinx import cache, hydration
+from djangosphinx.connection import get_balancer, is_network_error, is_timeout_error, reset_client, supports_timeouts
+
+__all__ = ('SearchError', 'SearchTimeout', 'ConnectionError', 'SphinxSearch', 'SphinxRelation', 'SphinxQuerySet', 'batch')
 
 from django.contrib.contenttypes.models import ContentType
 from datetime import datetime, date
@@ -23,12 +28,34 @@ from datetime import datetime, date
 # server settings
 SPHINX_SERVER           = getattr(settings, 'SPHINX_SERVER', 'localhost')
 SPHINX_PORT             = int(getattr(settings, 'SPHINX_PORT', 3312))
+# A list of (host, port[, weight]) tuples or unix socket paths, see djangosphinx.connection
+SPHINX_SERVERS          = getattr(settings, 'SPHINX_SERVERS', None) or [(SPHINX_SERVER, SPHINX_PORT)]
 
 # These require search API 275 (Sphinx 0.9.8)
 SPHINX_RETRIES          = int(getattr(settings, 'SPHINX_RETRIES', 0))
 SPHINX_RETRIES_DELAY    = int(getattr(settings, 'SPHINX_RETRIES_DELAY', 5))
 
+# Default time limit for a search, in milliseconds (0 means no limit)
+SPHINX_TIMEOUT_MS       = int(getattr(settings, 'SPHINX_TIMEOUT_MS', 0))
+
+# Indexing and slicing a queryset fetches matches from searchd this many at a time
+SPHINX_WINDOW_SIZE      = int(getattr(settings, 'SPHINX_WINDOW_SIZE', 100))
+
+# Passages are built for this many results per excerpts request (0 means all of them
+# at once). Requests run concurrently if SPHINX_HYDRATION_THREADS is set.
+SPHINX_EXCERPTS_CHUNK_SIZE = int(getattr(settings, 'SPHINX_EXCERPTS_CHUNK_SIZE', 0))
+
 MAX_INT = int(2**31-1)
+MAX_DOCID = 2**64-1
+
+# How many primary keys to load per query when hydrating matches
+HYDRATION_CHUNK_SIZE = 500
+# Of a search's time limit, searchd gets at most this share, and leaves at least
+# this many milliseconds for the request and its results to cross the network
+MAX_QUERY_TIME_RATIO = 0.8
+MAX_QUERY_TIME_MARGIN_MS = 10
+# Backends which support row value IN clauses, for composite primary keys
+ROW_VALUE_VENDORS = ('postgresql', 'mysql')
 
 EMPTY_RESULT_SET = dict(
     matches=[],
@@ -41,8 +68,15 @@ EMPTY_RESULT_SET = dict(
 UNDEFINED = object()
 
 class SearchError(Exception): pass
+class SearchTimeout(SearchError): pass
 class ConnectionError(Exception): pass
 
+def search_error(error):
+    "Returns the exception to raise for an error reported by the Sphinx API"
+    if is_timeout_error(error):
+        return SearchTimeout(error)
+    return SearchError(error)
+
 class SphinxProxy(object):
     """
     Acts exactly like a normal instance of an object except that
@@ -50,8 +84,11 @@ class SphinxProxy(object):
     
     If there is no `sphinx` attribute on the instance, it will also
     add a proxy wrapper to `_sphinx` under that name as well.
+
+    Proxies have no `__dict__` of their own, and attributes of the instance
+    are looked up on it directly, as templates read a lot of them.
     """
-    __slots__ = ('__dict__', '__instance__', '_sphinx', 'sphinx')
+    __slots__ = ('__instance__', '_sphinx')
 
     def __init__(self, instance, attributes):
         object.__setattr__(self, '__instance__', instance)
@@ -98,22 +135,12 @@ class SphinxProxy(object):
         except RuntimeError:
             return []
 
-    # def __getattribute__(self, name):
-    #     if not hasattr(self._current_object, 'sphinx') and name == 'sphinx':
-    #         name = '_sphinx'
-    #     if name == '_sphinx':
-    #         return object.__getattribute__(self, name)
-    #     print object.__getattribute__(self, '_current_object')
-    #     return getattr(object.__getattribute__(self, '_current_object'), name)
-
-    def __getattr__(self, name, value=UNDEFINED):
-        if not hasattr(self._current_object, 'sphinx') and name == 'sphinx':
-            name = '_sphinx'
-        if name == '_sphinx':
-            return getattr(self, '_sphinx', value)
-        if value == UNDEFINED:
-            return getattr(self._current_object, name)
-        return getattr(self._current_object, name, value)
+    def __getattr__(self, name):
+        # Only called for names the proxy doesn't have itself (`_sphinx` is a slot)
+        instance = self.__instance__
+        if name == 'sphinx' and not hasattr(instance, 'sphinx'):
+            return self._sphinx
+        return getattr(instance, name)
 
     def __setattr__(self, name, value):
         if name == '_sphinx':
@@ -182,6 +209,105 @@ class SphinxProxy(object):
     __enter__ = lambda x: x.__enter__()
     __exit__ = lambda x, *a, **kw: x.__exit__(*a, **kw)
 
+class LazyResultPage(object):
+    """
+    The matches of one evaluation of a lazy queryset, whose instances are
+    loaded together the first time any of them is needed.
+    """
+    def __init__(self, queryset, results, groups):
+        self.queryset = queryset
+        self.results = results
+        self.groups = groups
+        self.objects = None
+        self.models = None
+
+    def load(self):
+        if self.objects is None:
+            self.objects = self.queryset._load_objects(self.results, self.groups)
+        return self.objects
+
+    def get_model(self, position):
+        "Returns the model of the match at ``position``, without loading anything"
+        if self.models is None:
+            self.models = {}
+            for queryset, pks, positions, keys in self.groups:
+                for i in positions:
+                    self.models[i] = queryset.model
+        return self.models.get(position)
+
+class LazySphinxProxy(SphinxProxy):
+    """
+    A SphinxProxy which doesn't load its instance until it is needed. The
+    match itself (`_sphinx`, with the id, weight and attrs) is there right
+    away, while accessing anything else loads the instances of every result
+    of its page in one go.
+
+    Matches whose object no longer exists in the database raise
+    ObjectDoesNotExist once loaded, rather than being left out. Truth tests,
+    repr() and comparisons don't load anything, or raise for those.
+
+    Passages (see ``set_options(passages=True)``) are built along with the
+    instances, so `_sphinx['passages']` is missing until the page is loaded.
+    """
+    __slots__ = ('_page', '_position')
+
+    def __init__(self, page, position, attributes):
+        object.__setattr__(self, '__instance__', UNDEFINED)
+        object.__setattr__(self, '_sphinx', attributes)
+        object.__setattr__(self, '_page', page)
+        object.__setattr__(self, '_position', position)
+
+    def _get_current_object(self):
+        instance = self.__instance__
+        if instance is UNDEFINED:
+            instance = self._page.load()[self._position]
+            object.__setattr__(self, '__instance__', instance)
+        if instance is None:
+            raise ObjectDoesNotExist, "Object for search result %s does not exist" % (self._sphinx['id'],)
+        return instance
+    _current_object = property(_get_current_object)
+
+    def __getattr__(self, name):
+        # The match is all there is to `sphinx`, unless the model has one of its own
+        if name == 'sphinx' and not hasattr(self._page.get_model(self._position), 'sphinx'):
+            return self._sphinx
+        self._get_current_object()
+        return SphinxProxy.__getattr__(self, name)
+
+    def __repr__(self):
+        instance = self.__instance__
+        if instance is UNDEFINED and self._page.objects is not None:
+            instance = self._page.objects[self._position]
+        if instance is UNDEFINED or instance is None:
+            return '<%s: %s>' % (self.__class__.__name__, self._sphinx['id'])
+        return repr(instance)
+
+    def __nonzero__(self):
+        # There is a match, whether or not its object still exists
+        return True
+
+    def __eq__(self, other):
+        if isinstance(other, LazySphinxProxy):
+            return self._page.get_model(self._position) is other._page.get_model(other._position) \
+                and self._sphinx['id'] == other._sphinx['id']
+        try:
+            return self._get_current_object() == other
+        except ObjectDoesNotExist:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+_content_type_models = {}
+
+def get_content_type_model(ct):
+    "Returns the model class for a content type id, looked up once per process"
+    try:
+        return _content_type_models[ct]
+    except KeyError:
+        model = _content_type_models[ct] = ContentType.objects.get_for_id(ct).model_class()
+        return model
+
 def to_sphinx(value):
     "Convert a value into a sphinx query value"
     if isinstance(value, date) or isinstance(value, datetime):
@@ -191,7 +317,7 @@ def to_sphinx(value):
     return int(value)
 
 class SphinxQuerySet(object):
-    available_kwargs = ('rankmode', 'mode', 'weights', 'maxmatches', 'passages', 'passages_opts')
+    available_kwargs = ('rankmode', 'mode', 'weights', 'maxmatches', 'passages', 'passages_opts', 'offset', 'limit', 'timeout_ms')
     
     def __init__(self, model=None, using=None, **kwargs):
         self._select_related        = False
@@ -200,8 +326,11 @@ class SphinxQuerySet(object):
         self._filters               = {}
         self._excludes              = {}
         self._extra                 = {}
+        self._only                  = None
+        self._defer                 = []
+        self._prefetch_related      = []
         self._query                 = ''
-        self.__metadata             = None
+        self._metadata              = None
         self._offset                = 0
         self._limit                 = 20
 
@@ -212,15 +341,24 @@ class SphinxQuerySet(object):
         self._passages              = False
         self._passages_opts         = {}
         self._maxmatches            = 1000
+        self._timeout_ms            = SPHINX_TIMEOUT_MS
         self._result_cache          = None
+        self._windows               = {}
+        self._columnar              = False
+        self._lazy                  = False
+        self._values_fields         = None
+        self._values_format         = None
+        self._after_id              = None
+        self._id_range              = None
         self._mode                  = sphinxapi.SPH_MATCH_ALL
         self._rankmode              = getattr(sphinxapi, 'SPH_RANK_PROXIMITY_BM25', None)
         self.model                  = model
         self._anchor                = {}
-        self.__metadata             = {}
+        self._metadata              = {}
         
         self.using                  = using
         
+        kwargs.setdefault('rankmode', 'SPH_RANK_NONE')
         options = self._format_options(**kwargs)
         for key, value in options.iteritems():
             setattr(self, key, value)
@@ -237,6 +375,9 @@ class SphinxQuerySet(object):
             return '<%s instance>' % (self.__class__.__name__,)
 
     def __len__(self):
+        # Loading the results also gets us their totals, so count() doesn't
+        # have to ask searchd again
+        self._get_data()
         return self.count()
         
     def __iter__(self):
@@ -248,33 +389,34 @@ class SphinxQuerySet(object):
         assert (not isinstance(k, slice) and (k >= 0)) \
             or (isinstance(k, slice) and (k.start is None or k.start >= 0) and (k.stop is None or k.stop >= 0)), \
             "Negative indexing is not supported."
+        if type(k) == slice:
+            start = k.start or 0
+            stop = k.stop
+            if stop is None:
+                stop = self._maxmatches
+        else:
+            start, stop = k, k+1
         if self._result_cache is not None:
             # Check to see if this is a portion of an already existing result cache
-            if type(k) == slice:
-                start = k.start
-                stop = k.stop-k.start
-                if start < self._offset or k.stop > self._limit:
-                    self._result_cache = None
-                else:
-                    start = start-self._offset
-                    return self._get_data()[start:k.stop]
-            else:
-                if k not in range(self._offset, self._limit+self._offset):
-                    self._result_cache = None
-                else:
-                    return self._get_data()[k-self._offset]
+            if start >= self._offset and stop <= self._offset+self._limit:
+                if type(k) == slice:
+                    return self._result_cache[start-self._offset:stop-self._offset]
+                return self._result_cache[k-self._offset]
+        # Only the matches asked for are turned into model instances
+        results = self._get_window_results(start, stop)
+        self._offset = start
+        self._limit = max(stop-start, 0)
+        self._result_cache = list(self._get_results(results))
         if type(k) == slice:
-            self._offset = k.start
-            self._limit = k.stop-k.start
-            return self._get_data()
-        else:
-            self._offset = k
-            self._limit = 1
-            return self._get_data()[0]
+            return self._result_cache
+        return self._result_cache[0]
 
     def _format_options(self, **kwargs):
-        kwargs['rankmode'] = getattr(sphinxapi, kwargs.get('rankmode', 'SPH_RANK_NONE'), None)
-        kwargs['mode'] = getattr(sphinxapi, kwargs.get('mode', 'SPH_MATCH_ALL'), sphinxapi.SPH_MATCH_ALL)
+        # Only translate the modes we were given, so set_options() leaves the others alone
+        if 'rankmode' in kwargs:
+            kwargs['rankmode'] = getattr(sphinxapi, kwargs['rankmode'], None)
+        if 'mode' in kwargs:
+            kwargs['mode'] = getattr(sphinxapi, kwargs['mode'], sphinxapi.SPH_MATCH_ALL)
 
         kwargs = dict([('_%s' % (key,), value) for key, value in kwargs.iteritems() if key in self.available_kwargs])
         return kwargs
@@ -319,7 +461,8 @@ class SphinxQuerySet(object):
                 v = list(v)
             elif not (isinstance(v, list) or isinstance(v, tuple)):
                  v = [v,]
-            filters.setdefault(k, []).extend(map(to_sphinx, v))
+            # The lists are shared with the querysets this one was cloned from
+            filters[k] = filters.get(k, []) + map(to_sphinx, v)
         return self._clone(_filters=filters)
 
     def geoanchor(self, lat_attr, lng_attr, lat, lng):
@@ -332,9 +475,7 @@ class SphinxQuerySet(object):
         return self
     
     def none(self):
-        c = EmptySphinxQuerySet()
-        c.__dict__.update(self.__dict__.copy())
-        return c
+        return self._clone(klass=EmptySphinxQuerySet)
         
     # only works on attributes
     def exclude(self, **kwargs):
@@ -344,7 +485,7 @@ class SphinxQuerySet(object):
                 v = list(v)
             elif not (isinstance(v, list) or isinstance(v, tuple)):
                  v = [v,]
-            filters.setdefault(k, []).extend(map(to_sphinx, v))
+            filters[k] = filters.get(k, []) + map(to_sphinx, v)
         return self._clone(_excludes=filters)
 
     def escape(self, value):
@@ -388,33 +529,162 @@ class SphinxQuerySet(object):
         extra.update(kwargs)
         return self._clone(_extra=extra)
 
+    def only(self, *fields):
+        return self._clone(_only=list(fields))
+
+    def defer(self, *fields):
+        if fields == (None,):
+            return self._clone(_defer=[])
+        return self._clone(_defer=self._defer + list(fields))
+
+    def prefetch_related(self, *lookups):
+        assert hasattr(QuerySet, 'prefetch_related'), "prefetch_related() requires Django 1.4 or later."
+        if lookups == (None,):
+            return self._clone(_prefetch_related=[])
+        return self._clone(_prefetch_related=self._prefetch_related + list(lookups))
+
     def count(self):
-        return min(self._sphinx.get('total_found', 0), self._maxmatches)
+        return min(self._get_metadata().get('total_found', 0), self._maxmatches)
+
+    def exists(self):
+        return self._get_metadata().get('total_found', 0) > 0
+
+    def iterator(self, chunk_size=1000):
+        """
+        Yields every match of this search, even beyond ``maxmatches``, in order
+        of document id. Matches are fetched and loaded ``chunk_size`` at a time,
+        each chunk picking up after the last id of the one before, so only a
+        single chunk is held in memory at once.
+        """
+        for chunk in self._iter_chunks(chunk_size):
+            for result in chunk:
+                yield result
+
+    def scan(self, callback, partitions=4, workers=None, chunk_size=1000, progress=None):
+        """
+        Hands every match of this search to ``callback``, a chunk at a time,
+        splitting the id range into ``partitions`` scanned concurrently by
+        ``workers`` threads. See ``djangosphinx.scan.scan()``.
+        """
+        from djangosphinx.scan import scan
+        return scan(self, callback, partitions=partitions, workers=workers, chunk_size=chunk_size, progress=progress)
+
+    def _iter_chunks(self, chunk_size):
+        # Yields the results of iterator() as lists of up to chunk_size, and
+        # leaves the search metadata of the first chunk in _sphinx
+        assert(self._index)
+        assert not self._groupby, "iterator() can not be used with group_by()"
+        chunk_size = min(chunk_size, self._maxmatches)
+        qs = self._clone(_offset=0, _limit=chunk_size, _sort=(sphinxapi.SPH_SORT_EXTENDED, '@id ASC'))
+        while True:
+            results = qs._get_sphinx_results() or EMPTY_RESULT_SET
+            matches = results['matches']
+            if not matches:
+                break
+            if qs._after_id is None:
+                self._metadata = {
+                    'total': results['total'],
+                    'total_found': results['total_found'],
+                    'words': results['words'],
+                }
+            last_id = matches[-1]['id']
+            yield qs._get_results(results)
+            if len(matches) < chunk_size:
+                break
+            qs = qs._clone(_after_id=last_id)
+
+    def values(self, *fields):
+        """
+        Returns the matches as dictionaries of the given fields, read straight
+        from the search results without touching the database. Fields are
+        '@id', '@weight' and the index's attributes, all of them by default.
+        """
+        return self._clone(_values_fields=fields, _values_format='dict')
+
+    def values_list(self, *fields, **kwargs):
+        """
+        Like ``values()``, but returns tuples instead of dictionaries, or single
+        values if ``flat`` is True and only one field is given.
+        """
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s' % (kwargs.keys(),))
+        if flat and len(fields) != 1:
+            raise TypeError("'flat' is only valid when values_list is called with one field.")
+        return self._clone(_values_fields=fields, _values_format=flat and 'flat' or 'tuple')
+
+    def lazy(self):
+        """
+        Returns results which carry their match (``_sphinx``) right away, and
+        only load the model instances of a page, all in one go, the first time
+        one of them is accessed. Matches whose object has been deleted are
+        not left out, but raise ObjectDoesNotExist when accessed.
+        """
+        return self._clone(_lazy=True)
+
+    def columns(self):
+        """
+        Returns the matches of this search as a dictionary of columns rather than
+        model instances: one array each for '@id', '@weight' and every scalar
+        attribute, and an (offsets, values) pair of arrays for each MVA attribute.
+        The arrays are NumPy arrays if NumPy is installed.
+        """
+        assert hasattr(sphinxapi.SphinxClient, 'SetColumnar'), "You must use the bundled sphinxapi for Sphinx 0.9.9 (0x116) to use columnar results."
+        results = self._clone(_columnar=True)._get_sphinx_results() or EMPTY_RESULT_SET
+        self._metadata = {
+            'total': results['total'],
+            'total_found': results['total_found'],
+            'words': results['words'],
+        }
+        return results.get('columns', {})
 
     def reset(self):
         return self.__class__(self.model, self._index)
 
     # Internal methods
     def _get_sphinx_client(self):
-        client = sphinxapi.SphinxClient()
-        client.SetServer(SPHINX_SERVER, SPHINX_PORT)
-        return client
-
-    def _clone(self, **kwargs):
-        # Clones the queryset passing any changed args
-        c = self.__class__()
-        c.__dict__.update(self.__dict__.copy())
+        return get_balancer(SPHINX_SERVERS).get_client()
+
+    def _clone(self, klass=None, **kwargs):
+        # Clones the queryset passing any changed args. The clone shares the
+        # search settings with this queryset, so they are only ever replaced,
+        # never changed in place. Results are not shared.
+        if klass is None:
+            klass = self.__class__
+        c = klass.__new__(klass)
+        c.__dict__.update(self.__dict__)
+        c._result_cache = None
+        c._windows = {}
+        c._metadata = {}
         for k, v in kwargs.iteritems():
             setattr(c, k, v)
         return c
     
     def _sphinx(self):
-        if not self.__metadata:
+        if not self._metadata:
             # We have to force execution if this is accessed beforehand
             self._get_data()
-        return self.__metadata
+        return self._metadata
     _sphinx = property(_sphinx)
 
+    def _get_metadata(self):
+        """
+        Returns the search metadata (total, total_found and words) without
+        loading any model instances, running a single-match search if the
+        queryset has not been evaluated yet.
+        """
+        if not self._metadata:
+            if self._windows:
+                results = self._windows.values()[0]
+            else:
+                results = self._clone(_offset=0, _limit=1, _passages=False, _columnar=False)._get_sphinx_results() or EMPTY_RESULT_SET
+            self._metadata = {
+                'total': results['total'],
+                'total_found': results['total_found'],
+                'words': results['words'],
+            }
+        return self._metadata
+
     def _get_data(self):
         assert(self._index)
         # need to find a way to make this work yet
@@ -422,11 +692,129 @@ class SphinxQuerySet(object):
             self._result_cache = list(self._get_results())
         return self._result_cache
 
+    def evaluate_async(self):
+        """
+        Starts this search without waiting for searchd to answer, and returns a
+        ``djangosphinx.nonblocking.Request``. Once the request is done (see
+        ``djangosphinx.nonblocking.wait()``) the queryset has been evaluated and
+        the request's ``result()`` returns it. Requires Sphinx 0.9.9 (0x116).
+        """
+        from djangosphinx.nonblocking import AsyncSphinxClient, Request
+
+        assert(self._index)
+        assert(self._offset + self._limit <= self._maxmatches)
+
+        endpoint = get_balancer(SPHINX_SERVERS).choose()
+        client = AsyncSphinxClient()
+        client.SetServer(endpoint.host, endpoint.port)
+        params = self._setup_sphinx_client(client)
+        if params is None:
+            self._result_cache = list(self._get_results(EMPTY_RESULT_SET))
+            return Request.finished(self)
+
+        key = None
+        if cache.SPHINX_RESULT_CACHE:
+            key = cache.get_key(client, self._query, self._index)
+            results = cache.get(key)
+            if results is not None:
+                self._result_cache = list(self._get_results(results))
+                return Request.finished(self)
+
+        def release():
+            # Also called for cancelled requests, which leave no error behind
+            endpoint.end(not is_network_error(client.GetLastError()))
+
+        def evaluate(results):
+            results = self._check_sphinx_results(results, client.GetLastError(), client.GetLastWarning(), params)
+            if key is not None and not client.GetLastWarning():
+                cache.set(key, results)
+            self._result_cache = list(self._get_results(results))
+            return self
+
+        endpoint.begin()
+        return client.QueryAsync(self._query, self._index).add_finalizer(release).add_callback(evaluate)
+
+    def _get_window_results(self, start, stop):
+        """
+        Returns the Sphinx results for matches ``start`` to ``stop``. Matches are
+        kept in windows of ``SPHINX_WINDOW_SIZE``, so later slices which fall into
+        them don't search again. Windows not fetched yet are fetched together.
+        """
+        stop = min(stop, self._maxmatches)
+        first = start // SPHINX_WINDOW_SIZE
+        last = (stop - 1) // SPHINX_WINDOW_SIZE
+        window = first
+        while window <= last:
+            results = self._windows.get(window)
+            if results is not None:
+                if len(results['matches']) < SPHINX_WINDOW_SIZE:
+                    # Nothing left beyond this one
+                    break
+                window += 1
+                continue
+            # Each run of missing windows is fetched with a single search, and
+            # split up into its windows afterwards
+            end = window
+            while end < last and end + 1 not in self._windows:
+                end += 1
+            offset = window * SPHINX_WINDOW_SIZE
+            limit = min((end - window + 1) * SPHINX_WINDOW_SIZE, self._maxmatches - offset)
+            results = self._clone(_offset=offset, _limit=limit)._get_sphinx_results() or EMPTY_RESULT_SET
+            for i in range(window, end + 1):
+                part = dict(results)
+                part['matches'] = results['matches'][(i - window) * SPHINX_WINDOW_SIZE:(i - window + 1) * SPHINX_WINDOW_SIZE]
+                self._windows[i] = part
+            window = end + 1
+
+        window = first
+        meta = None
+        matches = []
+        while window * SPHINX_WINDOW_SIZE < stop:
+            results = self._windows[window]
+            if meta is None:
+                meta = results
+            matches.extend(results['matches'])
+            if len(results['matches']) < SPHINX_WINDOW_SIZE:
+                # Nothing left beyond this one
+                break
+            window += 1
+        if meta is None:
+            return EMPTY_RESULT_SET
+        base = first * SPHINX_WINDOW_SIZE
+        results = dict(meta)
+        # Hydration writes to the matches, so hand it copies rather than our windows
+        results['matches'] = [dict(r) for r in matches[start-base:stop-base]]
+        return results
+
     def _get_sphinx_results(self):
         assert(self._offset + self._limit <= self._maxmatches)
 
         client = self._get_sphinx_client()
 
+        params = self._setup_sphinx_client(client)
+        if params is None:
+            # Fix for Sphinx throwing an assertion error when you pass it an empty limiter
+            return EMPTY_RESULT_SET
+
+        key = None
+        if cache.SPHINX_RESULT_CACHE:
+            key = cache.get_key(client, self._query, self._index)
+            results = cache.get(key)
+            if results is not None:
+                return results
+
+        results = client.Query(self._query, self._index)
+
+        results = self._check_sphinx_results(results, client.GetLastError(), client.GetLastWarning(), params)
+        if key is not None and not client.GetLastWarning():
+            cache.set(key, results)
+        return results
+
+    def _setup_sphinx_client(self, client):
+        """
+        Applies this queryset's search settings to ``client``, and returns the
+        list of params used for logging (or None if there is nothing to search).
+        """
         params = []
 
         if self._sort:
@@ -513,31 +901,61 @@ class SphinxQuerySet(object):
             params.append('rankmode=%s' % (self._rankmode,))
             client.SetRankingMode(self._rankmode)
 
+        if self._id_range is not None or self._after_id is not None:
+            # The partition of scan() and cursor of iterator(), within whatever
+            # id range the filters set
+            min_id, max_id = client._min_id, client._max_id or MAX_DOCID
+            if self._id_range is not None:
+                min_id = max(min_id, self._id_range[0])
+                max_id = min(max_id, self._id_range[1])
+            if self._after_id is not None:
+                min_id = max(min_id, self._after_id + 1)
+            if min_id > max_id:
+                return None
+            client.SetIDRange(min_id, max_id)
+
         if not self._limit > 0:
-            # Fix for Sphinx throwing an assertion error when you pass it an empty limiter
-            return EMPTY_RESULT_SET
+            return None
         
         if sphinxapi.VER_COMMAND_SEARCH >= 0x113:
             client.SetRetries(SPHINX_RETRIES, SPHINX_RETRIES_DELAY)
         
         client.SetLimits(int(self._offset), int(self._limit), int(self._maxmatches))
+
+        if self._timeout_ms:
+            params.append('timeout_ms=%s' % (self._timeout_ms,))
+            self._set_timeout(client)
+            if hasattr(client, 'SetMaxQueryTime'):
+                # Have searchd give up (returning what it found so far) in time for
+                # its results to reach us before we give up on them
+                timeout_ms = int(self._timeout_ms)
+                client.SetMaxQueryTime(max(1, min(int(timeout_ms * MAX_QUERY_TIME_RATIO), timeout_ms - MAX_QUERY_TIME_MARGIN_MS)))
+
+        if self._columnar:
+            client.SetColumnar(True)
         
         # To avoid modifying the Sphinx API, we solve unicode indexes here
         if isinstance(self._index, unicode):
             self._index = self._index.encode('utf-8')
-        
-        results = client.Query(self._query, self._index)
-        
+
+        return params
+
+    def _set_timeout(self, client):
+        # Socket timeouts require search API 278 (Sphinx 0.9.9)
+        if self._timeout_ms and supports_timeouts():
+            client.SetTimeout(self._timeout_ms / 1000.0)
+
+    def _check_sphinx_results(self, results, error, warning, params):
         # The Sphinx API doesn't raise exceptions
 
         if not results:
-            if client.GetLastError():
-                raise SearchError, client.GetLastError()
-            elif client.GetLastWarning():
-                raise SearchError, client.GetLastWarning()
+            if error:
+                raise search_error(error)
+            elif warning:
+                raise SearchError, warning
             else:
                 results = EMPTY_RESULT_SET
-        elif not results['matches']:
+        elif not results['matches'] and 'columns' not in results:
             results = EMPTY_RESULT_SET
         
         logging.debug('Found %s results for search query %s on %s with params: %s', results['total'], self._query, self._index, ', '.join(params))
@@ -546,127 +964,315 @@ class SphinxQuerySet(object):
     
     def get(self, **kwargs):
         """Hack to support ModelAdmin"""
-        queryset = self.model._default_manager
+        return self._apply_query_options(self.model._default_manager.all()).get(**kwargs)
+
+    def _apply_query_options(self, queryset):
+        # Passes select_related(), extra(), only(), defer() and prefetch_related() on to the ORM
         if self._select_related:
             queryset = queryset.select_related(*self._select_related_fields, **self._select_related_args)
         if self._extra:
             queryset = queryset.extra(**self._extra)
-        return queryset.get(**kwargs)
-
-    def _get_results(self):
-        results = self._get_sphinx_results()
+        if self._only is not None:
+            queryset = queryset.only(*self._only)
+        if self._defer:
+            queryset = queryset.defer(*self._defer)
+        if self._prefetch_related:
+            queryset = queryset.prefetch_related(*self._prefetch_related)
+        return queryset
+
+    def _get_results(self, results=None):
+        if results is None:
+            results = self._get_sphinx_results()
         if not results:
             results = EMPTY_RESULT_SET
-        self.__metadata = {
+        self._metadata = {
             'total': results['total'],
             'total_found': results['total_found'],
             'words': results['words'],
         }
-        if results['matches'] and self._passages:
-            # We need to do some initial work for passages
-            # XXX: The passages implementation has a potential gotcha if your id
-            # column is not actually your primary key
-            words = ' '.join([w['word'] for w in results['words']])
-            
-        if self.model:
-            if results['matches']:
-                queryset = self.get_query_set(self.model)
-                if self._select_related:
-                    queryset = queryset.select_related(*self._select_related_fields, **self._select_related_args)
-                if self._extra:
-                    queryset = queryset.extra(**self._extra)
-
-                # django-sphinx supports the compositepks branch
-                # as well as custom id columns in your sphinx configuration
-                # but all primary key columns still need to be present in the field list
-                pks = getattr(self.model._meta, 'pks', [self.model._meta.pk])
-                if results['matches'][0]['attrs'].get(pks[0].column):
-                    
-                    # XXX: Sometimes attrs is empty and we cannot have custom primary key attributes
-                    for r in results['matches']:
-                        r['id'] = ', '.join([unicode(r['attrs'][p.column]) for p in pks])
-            
-                    # Join our Q objects to get a where clause which
-                    # matches all primary keys, even across multiple columns
-                    q = reduce(operator.or_, [reduce(operator.and_, [Q(**{p.name: r['attrs'][p.column]}) for p in pks]) for r in results['matches']])
-                    queryset = queryset.filter(q)
-                else:
-                    for r in results['matches']:
-                        r['id'] = unicode(r['id'])
-                    queryset = queryset.filter(pk__in=[r['id'] for r in results['matches']])
-                queryset = dict([(', '.join([unicode(getattr(o, p.attname)) for p in pks]), o) for o in queryset])
-
-                if self._passages:
-                    # TODO: clean this up
-                    for r in results['matches']:
-                        if r['id'] in queryset:
-                            r['passages'] = self._get_passages(queryset[r['id']], results['fields'], words)
-                
-                results = [SphinxProxy(queryset[r['id']], r) for r in results['matches'] if r['id'] in queryset]
-            else:
-                results = []
-        else:
+        if self._values_format:
+            results = self._get_values(results)
+            self._result_cache = results
+            return results
+        if not self.model:
             "We did a query without a model, lets see if there's a content_type"
             results['attrs'] = dict(results['attrs'])
-            if 'content_type' in results['attrs']:
-                "Now we have to do one query per content_type"
-                objcache = {}
-                for r in results['matches']:
-                    ct = r['attrs']['content_type']
-                    r['id'] = unicode(r['id'])
-                    objcache.setdefault(ct, {})[r['id']] = None
-                for ct in objcache:
-                    model_class = ContentType.objects.get(pk=ct).model_class()
-                    pks = getattr(model_class._meta, 'pks', [model_class._meta.pk])
-                    
-                    if results['matches'][0]['attrs'].get(pks[0].column):
-                        for r in results['matches']:
-                            if r['attrs']['content_type'] == ct:
-                                val = ', '.join([unicode(r['attrs'][p.column]) for p in pks])
-                                objcache[ct][r['id']] = r['id'] = val
-                    
-                        q = reduce(operator.or_, [reduce(operator.and_, [Q(**{p.name: r['attrs'][p.column]}) for p in pks]) for r in results['matches'] if r['attrs']['content_type'] == ct])
-                        queryset = self.get_query_set(model_class).filter(q)
-                    else:
-                        queryset = self.get_query_set(model_class).filter(pk__in=[r['id'] for r in results['matches'] if r['attrs']['content_type'] == ct])
-
-                    for o in queryset:
-                        objcache[ct][', '.join([unicode(getattr(o, p.name)) for p in pks])] = o
-                
-                if self._passages:
-                    for r in results['matches']:
-                        ct = r['attrs']['content_type']
-                        if r['id'] in objcache[ct]:
-                            r['passages'] = self._get_passages(objcache[ct][r['id']], results['fields'], words)
-                results = [SphinxProxy(objcache[r['attrs']['content_type']][r['id']], r) for r in results['matches'] if r['id'] in objcache[r['attrs']['content_type']]]
-            else:
+            if 'content_type' not in results['attrs']:
                 results = results['matches']
+                self._result_cache = results
+                return results
+
+        matches = results['matches']
+        groups = matches and self._get_match_groups(matches) or []
+        if self._lazy:
+            page = LazyResultPage(self, results, groups)
+            results = [LazySphinxProxy(page, i, r) for i, r in enumerate(matches)]
+        else:
+            objects = self._load_objects(results, groups)
+            results = [SphinxProxy(obj, r) for r, obj in zip(matches, objects) if obj is not None]
         self._result_cache = results
         return results
 
-    def _get_passages(self, instance, fields, words):
-        client = self._get_sphinx_client()
+    def _get_match_groups(self, matches):
+        """
+        Returns a (queryset, pks, positions, keys) tuple for each model the
+        matches belong to, with the positions of its matches and their
+        primary keys.
+        """
+        if self.model:
+            queryset = self._apply_query_options(self.get_query_set(self.model))
+            pks, keys = self._get_match_keys(self.model, matches)
+            return [(queryset, pks, range(len(matches)), keys)]
+
+        "Now we have to do one query per content_type"
+        by_ct = {}
+        for i, r in enumerate(matches):
+            by_ct.setdefault(r['attrs']['content_type'], []).append(i)
+        groups = []
+        for ct, positions in by_ct.iteritems():
+            model_class = get_content_type_model(ct)
+            pks, keys = self._get_match_keys(model_class, [matches[i] for i in positions])
+            groups.append((self.get_query_set(model_class), pks, positions, keys))
+        return groups
+
+    def _load_objects(self, results, groups):
+        """
+        Returns the instance for each match, or None where it no longer
+        exists, with passages added to the matches if they were asked for.
+        """
+        matches = results['matches']
+        objects = [None] * len(matches)
+        # One query per model, run concurrently if SPHINX_HYDRATION_THREADS is set
+        jobs = [lambda g=g: self._hydrate(g[0], g[1], g[3]) for g in groups]
+        for (queryset, pks, positions, keys), found in zip(groups, hydration.run_parallel(jobs)):
+            for i, key in zip(positions, keys):
+                objects[i] = found.get(key)
+
+        if matches and self._passages:
+            # XXX: The passages implementation has a potential gotcha if your id
+            # column is not actually your primary key
+            words = ' '.join([w['word'] for w in results['words']])
+            found = [(r, obj) for r, obj in zip(matches, objects) if obj is not None]
+            passages = self._get_passages([obj for r, obj in found], results['fields'], words)
+            for (r, obj), p in zip(found, passages):
+                r['passages'] = p
+        return objects
 
-        docs = [getattr(instance, f) for f in fields]
+    def _get_match_keys(self, model, matches):
+        """
+        Returns the primary key fields of ``model``, and the primary key of
+        each match as a tuple of values.
+        """
+        # django-sphinx supports the compositepks branch
+        # as well as custom id columns in your sphinx configuration
+        # but all primary key columns still need to be present in the field list
+        pks = getattr(model._meta, 'pks', [model._meta.pk])
+        if matches[0]['attrs'].get(pks[0].column):
+            # XXX: Sometimes attrs is empty and we cannot have custom primary key attributes
+            keys = [tuple([p.to_python(r['attrs'][p.column]) for p in pks]) for r in matches]
+        else:
+            pk = pks[0]
+            keys = [(pk.to_python(r['id']),) for r in matches]
+        for r, key in zip(matches, keys):
+            r['id'] = u', '.join([unicode(v) for v in key])
+        return pks, keys
+
+    def _hydrate(self, queryset, pks, keys):
+        """
+        Loads the objects with the given primary keys from ``queryset`` and
+        returns them keyed by their primary key tuples. Keys are looked up
+        ``HYDRATION_CHUNK_SIZE`` at a time, with an IN clause per chunk.
+        Instances already in the hydration cache are not loaded again, see
+        ``djangosphinx.hydration``.
+        """
+        objects = hydration.get_many(queryset, keys)
+        keys = [key for key in set(keys) if key not in objects]
+        loaded = {}
+        connection = connections[queryset.db]
+        for i in xrange(0, len(keys), HYDRATION_CHUNK_SIZE):
+            chunk = keys[i:i+HYDRATION_CHUNK_SIZE]
+            if len(pks) == 1:
+                qs = queryset.filter(pk__in=[key[0] for key in chunk])
+            elif connection.vendor in ROW_VALUE_VENDORS:
+                # (a, b) IN ((1, 2), (3, 4), ...)
+                qn = connection.ops.quote_name
+                table = qn(queryset.model._meta.db_table)
+                columns = ', '.join(['%s.%s' % (table, qn(p.column)) for p in pks])
+                row = '(%s)' % ', '.join(['%s'] * len(pks))
+                qs = queryset.extra(
+                    where=['(%s) IN (%s)' % (columns, ', '.join([row] * len(chunk)))],
+                    params=[p.get_db_prep_value(v, connection=connection) for key in chunk for p, v in zip(pks, key)],
+                )
+            else:
+                # One branch per distinct leading columns, with an IN on the last one
+                groups = {}
+                for key in chunk:
+                    groups.setdefault(key[:-1], []).append(key[-1])
+                qs = queryset.filter(reduce(operator.or_, [
+                    Q(**dict([(p.name, v) for p, v in zip(pks, prefix)] + [('%s__in' % pks[-1].name, values)]))
+                    for prefix, values in groups.iteritems()
+                ]))
+            for o in qs:
+                loaded[tuple([getattr(o, p.attname) for p in pks])] = o
+        hydration.set_many(queryset, loaded)
+        objects.update(loaded)
+        return objects
+
+    def _get_values(self, results):
+        fields = self._values_fields
+        if not fields:
+            fields = ['@id', '@weight'] + [a[0] for a in results['attrs']]
+        getters = []
+        for field in fields:
+            if field == '@id':
+                getters.append(operator.itemgetter('id'))
+            elif field == '@weight':
+                getters.append(operator.itemgetter('weight'))
+            else:
+                getters.append(lambda r, field=field: r['attrs'][field])
+        if self._values_format == 'flat':
+            getter = getters[0]
+            return [getter(r) for r in results['matches']]
+        rows = [tuple([g(r) for g in getters]) for r in results['matches']]
+        if self._values_format == 'dict':
+            return [dict(zip(fields, row)) for row in rows]
+        return rows
+
+    def _get_passages(self, instances, fields, words):
+        """
+        Returns the passages for each of ``instances``, as a dictionary of
+        excerpts by field. The excerpts for all of them are built with a single
+        request, or one per ``SPHINX_EXCERPTS_CHUNK_SIZE`` instances. Passages
+        found in the excerpt cache are not built again, see ``djangosphinx.cache``.
+        """
+        if not instances or not fields:
+            return [{} for instance in instances]
         if isinstance(self._passages_opts, dict):
             opts = self._passages_opts
         else:
             opts = {}
         if isinstance(self._index, unicode):
             self._index = self._index.encode('utf-8')
-        passages_list = client.BuildExcerpts(docs, self._index, words, opts)
-        
-        passages = {}
-        c = 0
-        for f in fields:
-            passages[f] = passages_list[c]
-            c += 1
+
+        docs = [[getattr(instance, f) for f in fields] for instance in instances]
+        passages = [None] * len(instances)
+        keys = None
+        if cache.SPHINX_EXCERPT_CACHE:
+            keys = [cache.get_excerpt_key(self._index, instance, d, words, opts) for instance, d in zip(instances, docs)]
+            found = cache.get_excerpts(keys)
+            passages = [found.get(key) for key in keys]
+        missing = [i for i, p in enumerate(passages) if p is None]
+        if not missing:
+            return passages
+
+        def build(chunk):
+            client = self._get_sphinx_client()
+            self._set_timeout(client)
+            excerpts = client.BuildExcerpts(chunk, self._index, words, dict(opts))
+            if not excerpts or len(excerpts) != len(chunk):
+                raise search_error(client.GetLastError())
+            return excerpts
+
+        pending = [doc for i in missing for doc in docs[i]]
+        size = len(pending)
+        if SPHINX_EXCERPTS_CHUNK_SIZE > 0:
+            size = SPHINX_EXCERPTS_CHUNK_SIZE * len(fields)
+        jobs = [lambda chunk=pending[i:i+size]: build(chunk) for i in xrange(0, len(pending), size)]
+        excerpts = []
+        for chunk in hydration.run_parallel(jobs):
+            excerpts.extend(chunk)
+
+        n = len(fields)
+        for j, i in enumerate(missing):
+            passages[i] = dict(zip(fields, excerpts[j*n:(j+1)*n]))
+        if keys is not None:
+            cache.set_excerpts(dict([(keys[i], passages[i]) for i in missing]))
         return passages
 
 class EmptySphinxQuerySet(SphinxQuerySet):
     def _get_sphinx_results(self):
         return None
 
+    def evaluate_async(self):
+        from djangosphinx.nonblocking import Request
+
+        self._result_cache = list(self._get_results(EMPTY_RESULT_SET))
+        return Request.finished(self)
+
+def batch(*querysets):
+    """
+    Evaluates several SphinxQuerySets using a single multi-query request to
+    searchd, rather than one round trip per queryset. Each queryset searches
+    using its current offset and limit, see ``set_options(offset=, limit=)``.
+
+    Returns the querysets that were passed in, which are now evaluated:
+    <code>
+        results, categories = batch(
+            MyModel.search.query('hello').set_options(offset=20, limit=20),
+            MyModel.search.query('hello').group_by('category_id', SPH_GROUPBY_ATTR),
+        )
+    </code>
+    """
+    pending = [qs for qs in querysets if qs._result_cache is None]
+    if not hasattr(sphinxapi.SphinxClient, 'AddQuery'):
+        # Multi-queries require search API 275 (Sphinx 0.9.8)
+        for qs in pending:
+            qs._get_data()
+        return querysets
+
+    client = get_balancer(SPHINX_SERVERS).get_client()
+    queued = []
+    # Querysets answered without searchd, which are turned into results only
+    # once the others have run: loading passages would reset the shared client
+    ready = []
+    timeouts = []
+    for qs in pending:
+        if isinstance(qs, EmptySphinxQuerySet):
+            qs._get_data()
+            continue
+        assert(qs._index)
+        assert(qs._offset + qs._limit <= qs._maxmatches)
+        params = qs._setup_sphinx_client(client)
+        key = cached = None
+        if params is not None and cache.SPHINX_RESULT_CACHE:
+            key = cache.get_key(client, qs._query, qs._index)
+            cached = cache.get(key)
+        if params is None:
+            ready.append((qs, EMPTY_RESULT_SET))
+        elif cached is not None:
+            ready.append((qs, cached))
+        else:
+            client.AddQuery(qs._query, qs._index)
+            queued.append((qs, params, key))
+            if qs._timeout_ms:
+                timeouts.append(qs._timeout_ms)
+        # Settings stick to the client between AddQuery() calls, so start the next
+        # query from the defaults again (keeping the queries added so far)
+        reqs = client._reqs
+        reset_client(client)
+        client._reqs = reqs
+
+    if queued:
+        # All queries go out in one request, which gets the tightest of their time limits
+        if timeouts and supports_timeouts():
+            client.SetTimeout(min(timeouts) / 1000.0)
+        results = client.RunQueries()
+        if not results:
+            raise search_error(client.GetLastError())
+
+        for (qs, params, key), result in zip(queued, results):
+            error, warning = result['error'], result['warning']
+            if result['status'] == sphinxapi.SEARCHD_ERROR:
+                result = None
+            result = qs._check_sphinx_results(result, error, warning, params)
+            if key is not None and not warning:
+                cache.set(key, result)
+            ready.append((qs, result))
+
+    for qs, result in ready:
+        qs._result_cache = list(qs._get_results(result))
+    return querysets
+
 class SphinxModelManager(object):
     def __init__(self, model, **kwargs):
         self.model = model
@@ -781,12 +1387,19 @@ class SphinxRelation(SphinxSearch):
         self._groupfunc = sphinxapi.SPH_GROUPBY_ATTR
         return self
 
-    def _get_results(self):
-        results = self._get_sphinx_results()
+    def _get_results(self, results=None):
+        if results is None:
+            results = self._get_sphinx_results()
         if not results or not results['matches']:
             # No matches so lets create a dummy result set
             results = EMPTY_RESULT_SET
-        elif self.model:
+        # Kept where SphinxQuerySet looks for it, so it doesn't search again
+        self._metadata = {
+            'total': results['total'],
+            'total_found': results['total_found'],
+            'words': results['words'],
+        }
+        if results['matches'] and self.model:
             ids = []
             for r in results['matches']:
                 value = r['attrs']['@groupby']
@@ -804,17 +1417,12 @@ class SphinxRelation(SphinxSearch):
             results = [ SphinxRelationProxy(queryset[k['attrs']['@groupby']], k) \
                         for k in results['matches'] \
                         if k['attrs']['@groupby'] in queryset ]
-        self.__metadata = {
-            'total': results['total'],
-            'total_found': results['total_found'],
-            'words': results['words'],
-        }
         self._result_cache = results
         return results
 
     def _sphinx(self):
-        if not self.__metadata:
+        if not self._metadata:
             # We have to force execution if this is accessed beforehand
             self._get_data()
-        return self.__metadata
+        return self._metadata
     _sphinx = property(_sphinx)
@@ -0,0 +1,311 @@
+"""
+Non-blocking requests to searchd.
+
+Rather than blocking the calling thread until searchd answers, requests are
+started on non-blocking sockets and driven to completion by ``wait()``, so a
+single thread can have many searches in flight at once:
+<code>
+    first = MyModel.search.query('foo').evaluate_async()
+    second = OtherModel.search.query('bar').evaluate_async()
+    wait(first, second)
+    for result in first.result():
+        ...
+</code>
+
+Requests can also be driven by an existing event loop: register ``fileno()``
+for reading (and for writing while ``want_write()`` is true), and call
+``process()`` whenever the socket is ready.
+
+A request made by a client with a timeout (see ``SetTimeout()``) fails once
+it runs out of time, as far as ``wait()`` is concerned; event loops driving
+requests themselves should check ``deadline``.
+
+This requires the bundled search API for Sphinx 0.9.9 (0x116), as it reuses
+its request building and response parsing.
+"""
+import errno
+import select
+import socket
+import sys
+import time
+from struct import pack, unpack
+
+import djangosphinx.apis.current as sphinxapi
+
+__all__ = ('AsyncSphinxClient', 'Request', 'wait')
+
+# request states
+CONNECTING, READ_VERSION, WRITE, READ_HEADER, READ_BODY, DONE = range(6)
+
+class Request(object):
+    """
+    A single request to searchd, running on its own non-blocking connection.
+    """
+    def __init__(self, client, command_ver, packet, parse, deadline=None):
+        self.client = client
+        self.command_ver = command_ver
+        self.parse = parse
+        self.deadline = deadline
+        self.callbacks = []
+        self.finalizers = []
+        self.state = CONNECTING
+        self.sock = None
+        self._result = None
+        self._exc_info = None
+        # we send our protocol version along with the request
+        self._out = pack('>L', 1) + packet
+        self._buffer = None
+        self._read = 0
+        self._header = None
+        self._connect()
+
+    def _connect(self):
+        client = self.client
+        if client._path:
+            af, addr, desc = socket.AF_UNIX, client._path, client._path
+        else:
+            af, addr = socket.AF_INET, (client._host, client._port)
+            desc = '%s;%s' % addr
+        self._desc = desc
+        try:
+            self.sock = socket.socket(af, socket.SOCK_STREAM)
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex(addr)
+        except socket.error, e:
+            return self._fail('connection to %s failed (%s)' % (desc, e))
+        if err in (0, errno.EISCONN):
+            self._start_read(READ_VERSION, 4)
+        elif err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self._fail('connection to %s failed (%s)' % (desc, errno.errorcode.get(err, err)))
+
+    def finished(cls, result):
+        """
+        Returns a request which is already done, for when there is nothing to send.
+        """
+        request = object.__new__(cls)
+        request.state = DONE
+        request.deadline = None
+        request.callbacks = []
+        request.finalizers = []
+        request._result = result
+        request._exc_info = None
+        return request
+    finished = classmethod(finished)
+
+    def _start_read(self, state, size):
+        self.state = state
+        self._buffer = memoryview(bytearray(size))
+        self._read = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def done(self):
+        return self.state == DONE
+
+    def want_write(self):
+        return self.state in (CONNECTING, WRITE)
+
+    def process(self):
+        """
+        Advances the request as far as possible without blocking. Call this
+        whenever the socket is ready for reading or writing.
+        """
+        try:
+            if self.state == CONNECTING:
+                err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    return self._fail('connection to %s failed (%s)' % (self._desc, errno.errorcode.get(err, err)))
+                self._start_read(READ_VERSION, 4)
+            if self.state == WRITE:
+                sent = self.sock.send(self._out)
+                self._out = self._out[sent:]
+                if not self._out:
+                    self._start_read(READ_HEADER, 8)
+            while self.state in (READ_VERSION, READ_HEADER, READ_BODY):
+                size = len(self._buffer)
+                if self._read < size:
+                    chunk = self.sock.recv_into(self._buffer[self._read:], size - self._read)
+                    if not chunk:
+                        return self._fail('connection to %s closed by searchd' % (self._desc,))
+                    self._read += chunk
+                    if self._read < size:
+                        return
+                self._advance()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._fail('connection to %s failed (%s)' % (self._desc, e))
+
+    def _advance(self):
+        # called once the buffer for the current read state is full
+        if self.state == READ_VERSION:
+            if unpack('>L', self._buffer)[0] < 1:
+                return self._fail('expected searchd protocol version, got %s' % unpack('>L', self._buffer)[0])
+            self.state = WRITE
+            self._buffer = None
+        elif self.state == READ_HEADER:
+            self._header = unpack('>2HL', self._buffer)
+            self._start_read(READ_BODY, self._header[2])
+        elif self.state == READ_BODY:
+            status, ver, length = self._header
+            response = self.client._CheckResponse(status, ver, length, self._buffer, self.command_ver)
+            if response is not None:
+                response = self.parse(response)
+            self._finish(response)
+
+    def cancel(self):
+        """
+        Abandons the request, closing its connection. Callbacks are not called,
+        finalizers are.
+        """
+        if not self.done():
+            self.callbacks = []
+            self._finish(None)
+
+    def _fail(self, error):
+        self.client._error = error
+        self._finish(None)
+
+    def _expire(self):
+        self.client._TimedOut(self.sock)
+        self._finish(None)
+
+    def _finish(self, result):
+        self.state = DONE
+        if self.sock is not None:
+            self.sock.close()
+        self._buffer = None
+        try:
+            for finalizer in self.finalizers:
+                finalizer()
+            for callback in self.callbacks:
+                result = callback(result)
+        except:
+            self._exc_info = sys.exc_info()
+        self._result = result
+
+    def add_finalizer(self, func):
+        """
+        Adds a function which is called (without arguments) once the request is
+        over, before any callbacks. Unlike callbacks, finalizers are also called
+        for cancelled requests, so they can release whatever the request holds.
+        """
+        if self.done():
+            func()
+        else:
+            self.finalizers.append(func)
+        return self
+
+    def add_callback(self, func):
+        """
+        Adds a function which is called with the result once the request is
+        done. Its return value replaces the result passed to the next callback
+        and returned by ``result()``.
+        """
+        if self.done():
+            try:
+                self._result = func(self._result)
+            except:
+                self._exc_info = sys.exc_info()
+        else:
+            self.callbacks.append(func)
+        return self
+
+    def result(self, timeout=None):
+        """
+        Returns the result of the request, waiting for it if needed. Like
+        SphinxClient, failures return None and are described by the client's
+        ``GetLastError()``.
+        """
+        if not self.done():
+            wait(self, timeout=timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+class AsyncSphinxClient(sphinxapi.SphinxClient):
+    """
+    A SphinxClient with non-blocking versions of its requests, each returning
+    a ``Request`` rather than the result.
+    """
+    def _Start(self, command_ver, packet, parse, deadline=None):
+        self._error = ''
+        self._warning = ''
+        if deadline is None and self._timeout:
+            deadline = time.time() + self._timeout
+        return Request(self, command_ver, packet, parse, deadline)
+
+    def RunQueriesAsync(self):
+        assert len(self._reqs), 'no queries defined, issue AddQuery() first'
+        nreqs = len(self._reqs)
+        packet = self._BuildSearchRequest()
+        self._reqs = []
+        return self._Start(sphinxapi.VER_COMMAND_SEARCH, packet,
+                           lambda response: self._ParseSearchResponse(response, nreqs))
+
+    def QueryAsync(self, query, index='*', comment=''):
+        assert(len(self._reqs)==0)
+        self.AddQuery(query, index, comment)
+        return self.RunQueriesAsync().add_callback(self._PickQueryResult)
+
+    def BuildExcerptsAsync(self, docs, index, words, opts=None):
+        if not opts:
+            opts = {}
+        if isinstance(words, unicode):
+            words = words.encode('utf-8')
+        packet = self._BuildExcerptsRequest(docs, index, words, opts)
+        return self._Start(sphinxapi.VER_COMMAND_EXCERPT, packet,
+                           lambda response: self._ParseExcerptsResponse(response, len(docs)))
+
+    def UpdateAttributesAsync(self, index, attrs, values):
+        packet = self._BuildUpdateRequest(index, attrs, values)
+        return self._Start(sphinxapi.VER_COMMAND_UPDATE, packet,
+                           lambda response: unpack('>L', response[0:4])[0])
+
+    def BuildKeywordsAsync(self, query, index, hits):
+        packet = self._BuildKeywordsRequest(query, index, hits)
+        return self._Start(sphinxapi.VER_COMMAND_KEYWORDS, packet,
+                           lambda response: self._ParseKeywordsResponse(response, hits))
+
+def wait(*requests, **kwargs):
+    """
+    Drives the given requests until all of them are done (or any of them, if
+    ``first`` is true), or until ``timeout`` seconds have passed. Requests which
+    pass their own deadline meanwhile fail. Returns the list of requests which
+    are done.
+    """
+    timeout = kwargs.get('timeout')
+    first = kwargs.get('first', False)
+    if timeout is not None:
+        deadline = time.time() + timeout
+    pending = [r for r in requests if not r.done()]
+    while pending and not (first and len(pending) < len(requests)):
+        now = time.time()
+        expired = [r for r in pending if r.deadline is not None and r.deadline <= now]
+        if expired:
+            for r in expired:
+                r._expire()
+            pending = [r for r in pending if not r.done()]
+            continue
+        deadlines = [r.deadline for r in pending if r.deadline is not None]
+        if timeout is not None:
+            if deadline <= now:
+                break
+            deadlines.append(deadline)
+        if deadlines:
+            remaining = min(deadlines) - now
+        else:
+            remaining = None
+        readable = [r for r in pending if not r.want_write()]
+        writable = [r for r in pending if r.want_write()]
+        try:
+            sr, sw, _ = select.select(readable, writable, [], remaining)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for r in sr + sw:
+            r.process()
+        pending = [r for r in pending if not r.done()]
+    return [r for r in requests if r.done()]
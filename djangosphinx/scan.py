@@ -0,0 +1,122 @@
+"""
+Parallel scans over every match of a search.
+
+``scan()`` splits the document id range of a search into partitions, and
+walks each of them with ``SphinxQuerySet.iterator()`` on a pool of threads.
+Every thread uses its own searchd and database connections:
+<code>
+    def tag(chunk):
+        for obj in chunk:
+            ...
+
+    def report(partition):
+        print partition.index, partition.done, partition.total
+
+    MyModel.search.query('foo').scan(tag, partitions=8, progress=report)
+</code>
+"""
+import sys
+import threading
+import Queue
+
+from django.db import connections
+
+__all__ = ('Partition', 'scan')
+
+class Partition(object):
+    """
+    A range of document ids scanned by one worker, and how far it got.
+    ``total`` is the number of matches in the range, once known.
+    """
+    def __init__(self, index, min_id, max_id):
+        self.index = index
+        self.min_id = min_id
+        self.max_id = max_id
+        self.done = 0
+        self.total = None
+        self.finished = False
+
+    def __repr__(self):
+        return '<%s %s: ids %s-%s, %s/%s>' % (self.__class__.__name__, self.index, self.min_id, self.max_id, self.done, self.total)
+
+def get_id_bounds(queryset):
+    """
+    Returns the lowest and highest document id matching ``queryset``, or
+    None if nothing matches.
+    """
+    from djangosphinx.models import batch
+
+    ids = queryset.values_list('@id', flat=True).set_options(offset=0, limit=1)
+    lowest, highest = batch(ids.order_by('@id'), ids.order_by('-@id'))
+    lowest, highest = list(lowest), list(highest)
+    if not lowest:
+        return None
+    return lowest[0], highest[0]
+
+def split(min_id, max_id, partitions):
+    """
+    Splits the ids from ``min_id`` to ``max_id`` into up to ``partitions``
+    ranges of equal size.
+    """
+    step = (max_id - min_id) // partitions + 1
+    return [Partition(i, min_id + i * step, min(max_id, min_id + (i + 1) * step - 1))
+            for i in range(partitions) if min_id + i * step <= max_id]
+
+def scan(queryset, callback, partitions=4, workers=None, chunk_size=1000, progress=None):
+    """
+    Calls ``callback`` with every match of ``queryset``, in chunks of up to
+    ``chunk_size``. The id range is split into ``partitions`` ranges which
+    ``workers`` threads (one per partition by default) scan concurrently, so
+    ``callback`` must be thread safe. ``progress``, if given, is called with
+    the ``Partition`` after each chunk.
+
+    Returns the list of partitions. If a callback fails, the remaining
+    partitions are abandoned and the first exception is raised again.
+    """
+    bounds = get_id_bounds(queryset)
+    if bounds is None:
+        return []
+    parts = split(bounds[0], bounds[1], partitions)
+
+    pending = Queue.Queue()
+    for partition in parts:
+        pending.put(partition)
+    errors = []
+
+    def work():
+        try:
+            while not errors:
+                try:
+                    partition = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                qs = queryset._clone(_id_range=(partition.min_id, partition.max_id))
+                for chunk in qs._iter_chunks(chunk_size):
+                    if partition.total is None:
+                        partition.total = qs._sphinx['total_found']
+                    callback(chunk)
+                    partition.done += len(chunk)
+                    if progress is not None:
+                        progress(partition)
+                    if errors:
+                        return
+                partition.finished = True
+                if progress is not None:
+                    progress(partition)
+        except:
+            errors.append(sys.exc_info())
+        finally:
+            # Each thread has its own database connections, which would stay open otherwise
+            for connection in connections.all():
+                connection.close()
+
+    threads = [threading.Thread(target=work) for i in range(min(workers or len(parts), len(parts)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return parts
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for building querysets and reading results, which don't
+need searchd:
+
+    python sphinxtest/benchmark.py
+
+Reports the time and allocations of each call in a chain of queryset
+methods, and those of attribute access through the ``SphinxProxy`` wrapping
+each result. Allocations are counted as the garbage collected objects a call
+leaves behind, and the bytes of the clone (the instance, its __dict__, and
+those of its settings it doesn't share with the queryset it came from).
+"""
+import gc
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+settings.configure(
+    INSTALLED_APPS=('django.contrib.contenttypes', 'sphinxtest.tests'),
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+)
+
+from djangosphinx.models import SphinxProxy, SphinxQuerySet
+from sphinxtest.tests.models import Document
+
+CALLS = 10
+NUMBER = 20000
+
+base = SphinxQuerySet(Document, index='test')
+
+def chain(keep=None):
+    steps = [
+        lambda qs: qs.query('hello'),
+        lambda qs: qs.filter(group_id=1),
+        lambda qs: qs.filter(tags=[1, 2]),
+        lambda qs: qs.exclude(group_id=3),
+        lambda qs: qs.order_by('-@weight', '@id'),
+        lambda qs: qs.set_options(passages=True),
+        lambda qs: qs.filter(score__gte=1),
+        lambda qs: qs.group_by('group_id', 4),
+        lambda qs: qs.filter(group_id=2),
+        lambda qs: qs.set_options(offset=20, limit=20),
+    ]
+    qs = base
+    for step in steps:
+        qs = step(qs)
+        if keep is not None:
+            keep.append(qs)
+    return qs
+
+def clone_size(parent, clone):
+    shared = set([id(v) for v in parent.__dict__.itervalues()])
+    size = sys.getsizeof(clone) + sys.getsizeof(clone.__dict__)
+    for value in clone.__dict__.itervalues():
+        if id(value) not in shared:
+            size += sys.getsizeof(value)
+    return size
+
+def time_proxy(stmt, number=200000):
+    setup = 'from __main__ import SphinxProxy, document, proxy'
+    return min(timeit.repeat(stmt, setup, number=number, repeat=3)) / number
+
+document = Document(id=1, title='title', content='content', group_id=1)
+proxy = SphinxProxy(document, {'id': 1, 'weight': 1, 'attrs': {}})
+
+def main():
+    seconds = min(timeit.repeat(chain, number=NUMBER, repeat=3)) / NUMBER
+
+    # Keep every clone alive, so the objects counted are the ones each call leaves behind
+    gc.collect()
+    gc.disable()
+    try:
+        keep = []
+        before = gc.get_count()[0]
+        chain(keep)
+        objects = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    sizes = [clone_size(parent, clone) for parent, clone in zip([base] + keep, keep)]
+
+    print 'queryset chain of %d calls' % CALLS
+    print '  time per call     %.2f us' % (seconds / CALLS * 1e6)
+    print '  objects per call  %.1f' % (objects / float(CALLS))
+    print '  bytes per clone   %d' % (sum(sizes) / len(sizes))
+
+    print 'result proxy'
+    for label, stmt in (('instance.title', 'document.title'),
+                        ('proxy.title', 'proxy.title'),
+                        ('proxy._sphinx', 'proxy._sphinx'),
+                        ('proxy.sphinx', 'proxy.sphinx'),
+                        ('new proxy', "SphinxProxy(document, {})")):
+        print '  %-17s %.3f us' % (label, time_proxy(stmt) * 1e6)
+    print '  bytes per proxy   %d' % sys.getsizeof(proxy)
+
+if __name__ == '__main__':
+    main()